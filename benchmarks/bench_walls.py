@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Times Gamemap._build_mesa_walls against the old tile-by-tile loop it replaced
+
+Usage: bench_walls.py [size ...]
+Sizes are the side lengths of square maps to test. Defaults to 1024 4096 8192.
+Each map is seeded with its size, and the masks' walls are checked against the loop's.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from gamemap import Gamemap, get_orthog_neighbors
+from tilemanager import TileManager
+
+def reference_build_mesa_walls(gamemap):
+    """The original per-tile implementation of _build_mesa_walls"""
+    for i_y, row in enumerate(gamemap.get_map_array()):
+        for i_x, tile in enumerate(row):
+            if tile == TileManager.floor:
+                for neighbor in get_orthog_neighbors(i_x, i_y):
+                    if neighbor[0] < gamemap.width and neighbor[1] < gamemap.height and gamemap.get(neighbor[0], neighbor[1]) == TileManager.impass:
+                        gamemap.set(neighbor[0], neighbor[1], TileManager.wall)
+
+def strip_walls(gamemap):
+    """Turns the map's walls back into impass tiles so the wall pass can be run again"""
+    grid = gamemap.get_map_array()
+    for y in range(grid.height):
+        walls = grid.row_mask(y, [TileManager.wall])
+        if walls:
+            grid.set_row_mask(y, walls, TileManager.impass)
+
+def map_codes(gamemap):
+    grid = gamemap.get_map_array()
+    return grid.read_rows(0, grid.height)
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def main(sizes):
+    print("{0:>6} {1:>12} {2:>12} {3:>8}".format("size", "loop (s)", "masks (s)", "speedup"))
+    for size in sizes:
+        gamemap = Gamemap(size, size, seed=size)
+
+        strip_walls(gamemap)
+        reference_time = time_call(reference_build_mesa_walls, gamemap)
+        expected = map_codes(gamemap)
+        strip_walls(gamemap)
+        mask_time = time_call(gamemap._build_mesa_walls)
+        if map_codes(gamemap) != expected:
+            raise AssertionError("Wall pass output differs from the tile-by-tile loop's at size {0}".format(size))
+
+        print("{0:>6} {1:>12.3f} {2:>12.3f} {3:>7.1f}x".format(size, reference_time, mask_time, reference_time/mask_time))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the wall pass against the tile-by-tile loop it replaced")
+    parser.add_argument("sizes", type=int, nargs="*", default=[1024, 4096, 8192], help="Side lengths of the square maps to test")
+    main(parser.parse_args().sizes)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Reports how much memory entities and patches take each
+
+Builds a batch of each kind of object under tracemalloc, with coordinates spread over a large
+map so they aren't all small cached ints, and divides the memory traced by the batch size.
+It then works out what a world of --entities entities and --mesas mesas would need, and exits
+with an error if that's over --budget-mb.
+
+Usage:
+    memory_report.py [--count 100000] [--entities 1000000] [--mesas 100000] [--budget-mb 512]
+"""
+import argparse
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from entities import Entity, ItemPickup, Signpost
+from patches import Bridge, Mesa
+from tilemanager import TileManager
+
+#Side length of the map the objects' coordinates are spread over
+MAP_SIZE = 65536
+MESA_RADII = (2, 4, 6, 12)
+BRIDGE_DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+DEFAULT_BUDGET_MB = 512
+
+##=======================================================##
+#Each maker takes a random.Random and returns one new object
+
+def make_entity(rand):
+    return Entity(TileManager.test_tile, rand.randrange(MAP_SIZE), rand.randrange(MAP_SIZE), None)
+
+def make_item_pickup(rand):
+    return ItemPickup(["a pebble"], rand.randrange(MAP_SIZE), rand.randrange(MAP_SIZE), None)
+
+def make_signpost(rand):
+    return Signpost("Beware", TileManager.test_tile, rand.randrange(MAP_SIZE), rand.randrange(MAP_SIZE), None)
+
+def make_mesa(rand):
+    return Mesa(rand.randrange(MAP_SIZE), rand.randrange(MAP_SIZE), rand.choice(MESA_RADII))
+
+def make_bridge(rand):
+    return Bridge(rand.randrange(MAP_SIZE), rand.randrange(MAP_SIZE), rand.randint(2, 40), rand.choice(BRIDGE_DIRECTIONS))
+
+MAKERS = [
+    ("entity", make_entity),
+    ("item_pickup", make_item_pickup),
+    ("signpost", make_signpost),
+    ("mesa", make_mesa),
+    ("bridge", make_bridge),
+]
+
+##=======================================================##
+
+def bytes_per_object(make, count, seed=0):
+    """Returns the mean memory traced per object over a batch of count objects"""
+    rand = random.Random(seed)
+    #Warm up caches, such as the mesa stencils, so they aren't charged to the batch
+    for i in range(100):
+        make(rand)
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    batch = [make(rand) for i in range(count)]
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    #Don't charge the list holding the batch to the objects in it
+    return (end - start - sys.getsizeof(batch)) / count
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the memory used per entity and per patch")
+    parser.add_argument('--count', type=int, default=100000, help="Objects of each kind to measure")
+    parser.add_argument('--entities', type=int, default=1000000, help="Entities in the projected world")
+    parser.add_argument('--mesas', type=int, default=100000, help="Mesas in the projected world")
+    parser.add_argument('--budget-mb', type=float, default=DEFAULT_BUDGET_MB,
+                        help="Fail if the projected world needs more than this")
+    args = parser.parse_args()
+
+    sizes = {}
+    for name, make in MAKERS:
+        sizes[name] = bytes_per_object(make, args.count)
+        print("{0:<12} {1:>8.1f} bytes each".format(name, sizes[name]))
+
+    #Every mesa gets bridged to a neighbour, so there are about as many bridges as mesas
+    worst_entity = max(sizes["entity"], sizes["item_pickup"], sizes["signpost"])
+    projected = args.entities * worst_entity + args.mesas * (sizes["mesa"] + sizes["bridge"])
+    projected_mb = projected / (1024 * 1024)
+    print("{0} entities and {1} mesas with bridges: {2:.1f} MB (budget {3:.0f} MB)".format(
+        args.entities, args.mesas, projected_mb, args.budget_mb))
+    if projected_mb > args.budget_mb:
+        sys.exit("Over budget")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Times the whole interface, from keypress to redraw, without a terminal
+
+Replays a key session through the real game loop, key handling and panels on a headless
+screen, and reports turns per second. The session is either a file recorded with
+`main.py --record`, or a random mix of moves and menu keys.
+
+Usage:
+    replay_session.py [--keys 100000] [--seed 0] [--recording FILE] [--width 120] [--height 40]
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import headless
+import keyinput
+
+#Keys a random session is drawn from, mostly moves, with the odd trip into a menu and out again
+SESSION_KEYS = "hjklyubn" * 4 + "id" + "0q"
+
+def random_session(key_count, seed):
+    rand = random.Random(seed)
+    return [rand.choice(SESSION_KEYS) for i in range(key_count)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a key session headless and report turns per second")
+    parser.add_argument('--keys', type=int, default=100000, help="Length of a random session")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the random session and the map")
+    parser.add_argument('--recording', metavar='FILE', help="Replay keys saved by main.py --record instead")
+    parser.add_argument('--width', type=int, default=120)
+    parser.add_argument('--height', type=int, default=40)
+    args = parser.parse_args()
+
+    if args.recording is not None:
+        keys = keyinput.load_recording(args.recording)
+    else:
+        keys = random_session(args.keys, args.seed)
+    result = headless.replay_session(keys, width=args.width, height=args.height, seed=args.seed)
+    print("{0} keys in {1:.2f}s: {2:.0f} turns per second, {3} frames drawn, {4} ticks".format(
+        result["keys"], result["seconds"], result["turns_per_second"], result["frames"], result["ticks"]))
+
+if __name__ == '__main__':
+    main()
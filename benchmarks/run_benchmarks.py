@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Benchmarks for the map generation and rendering hot paths
+
+Every case runs with fixed seeds, and reports the mean and 95th percentile time over a number of
+repeats, plus the peak memory allocated during one extra, separately traced run.
+
+Usage:
+    run_benchmarks.py [--sizes 256 1024] [--repeat 10] [--only NAME ...] [--out results.json]
+    run_benchmarks.py --compare old.json new.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from fov import FieldOfView
+from gamemap import Gamemap
+from patches import Mesa, get_mesa_stencil
+from screenpanels import GamePanel, TextPanel, wrap_message
+
+DEFAULT_MAP_SIZES = [256, 1024]
+MESA_RADII = [0, 2, 4, 6, 12, 24]
+MESSAGE_WORDS = [100, 1000, 10000]
+FOV_RADII = [8, 20, 40]
+#Ratio of new to old mean time past which --compare calls a case a regression
+REGRESSION_THRESHOLD = 1.10
+
+class FakeWindow(object):
+    """Just enough of a curses window for the panels to draw into"""
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+
+    def getmaxyx(self):
+        return (self.height, self.width)
+
+    def addch(self, y, x, char, attr=0):
+        pass
+
+    def addstr(self, y, x, string, attr=0):
+        pass
+
+##=======================================================##
+#Each benchmark takes a parameter and returns a function to time.
+#Setup work done outside the returned function isn't counted.
+
+def bench_gamemap_construction(size):
+    return lambda: Gamemap(size, size, seed=size)
+
+def bench_poisson_construction(size):
+    return lambda: Gamemap(size, size, seed=size, layout="poisson")
+
+def bench_build_mesa_walls(size):
+    gamemap = Gamemap(size, size, seed=size)
+    return gamemap._build_mesa_walls
+
+def bench_apply_patch(size):
+    gamemap = Gamemap(size, size, seed=size)
+    rng = random.Random(size)
+    mesas = []
+    for i in range(1000):
+        r = rng.randint(0, 6)
+        mesas.append(Mesa(rng.randint(0, size-(2*r + 1)), rng.randint(0, size-(2*r + 1)), r))
+    def apply_all():
+        for mesa in mesas:
+            gamemap.apply_patch(mesa)
+    return apply_all
+
+def bench_label_components(size):
+    gamemap = Gamemap(size, size, seed=size)
+    return gamemap.label_components
+
+def bench_connect_mesas(size):
+    #Connecting changes the map, so each run has to generate a fresh one, and that's counted too
+    class UnconnectedGamemap(Gamemap):
+        connect_islands = False
+    def connect():
+        UnconnectedGamemap(size, size, seed=size).connect_mesas()
+    return connect
+
+def bench_mesa_construction(r):
+    def construct():
+        get_mesa_stencil.cache_clear()
+        Mesa(0, 0, r)
+    return construct
+
+def bench_field_of_view_x100(radius):
+    gamemap = Gamemap(256, 256, seed=radius)
+    fov = FieldOfView(gamemap)
+    rng = random.Random(radius)
+    origins = [(rng.randrange(256), rng.randrange(256)) for i in range(100)]
+    def cast_all():
+        #Bypass the cache, which would otherwise make every run after the first free
+        for x, y in origins:
+            fov._cast(x, y, radius)
+    return cast_all
+
+def bench_gamemap_str(size):
+    gamemap = Gamemap(size, size, seed=size)
+    return lambda: str(gamemap)
+
+def bench_gamepanel_display(size):
+    gamemap = Gamemap(size, size, seed=size)
+    panel = GamePanel(FakeWindow(100, 300))
+    return lambda: panel.display(gamemap.get_map_array())
+
+def bench_trim_message(words):
+    rng = random.Random(words)
+    message = " ".join("".join(rng.choice("abcdefghij") for i in range(rng.randint(1, 12))) for j in range(words))
+    panel = TextPanel(FakeWindow(40, 60))
+    def trim():
+        #Time the wrapping itself, not a cache hit
+        wrap_message.cache_clear()
+        panel._trim_message(message)
+    return trim
+
+BENCHMARKS = [
+    ("gamemap_construction", bench_gamemap_construction, "size"),
+    ("poisson_construction", bench_poisson_construction, "size"),
+    ("build_mesa_walls", bench_build_mesa_walls, "size"),
+    ("apply_patch_x1000", bench_apply_patch, "size"),
+    ("label_components", bench_label_components, "size"),
+    ("connect_mesas", bench_connect_mesas, "size"),
+    ("mesa_construction", bench_mesa_construction, MESA_RADII),
+    ("field_of_view_x100", bench_field_of_view_x100, FOV_RADII),
+    ("gamemap_str", bench_gamemap_str, "size"),
+    ("gamepanel_display_300x100", bench_gamepanel_display, "size"),
+    ("trim_message", bench_trim_message, MESSAGE_WORDS),
+]
+
+##=======================================================##
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1)]
+
+def measure(func, repeat):
+    """Times func repeat times, then runs it once more under tracemalloc for its peak memory"""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"mean": sum(times) / len(times),
+            "p95": percentile(times, .95),
+            "peak_bytes": peak,
+            "repeat": repeat}
+
+def run(map_sizes, repeat, only=None):
+    """Runs the benchmarks and returns {case name: result}"""
+    results = {}
+    for name, bench, params in BENCHMARKS:
+        if only and name not in only:
+            continue
+        for param in (map_sizes if params == "size" else params):
+            case = "{0}[{1}]".format(name, param)
+            results[case] = measure(bench(param), repeat)
+            print_result(case, results[case])
+    return results
+
+def print_result(case, result):
+    print("{0:<40} mean {1:>10.3f}ms  p95 {2:>10.3f}ms  peak {3:>10.1f}KB".format(
+        case, result["mean"] * 1000, result["p95"] * 1000, result["peak_bytes"] / 1024))
+
+def compare(old_results, new_results):
+    """Prints how each case's mean time changed, and returns the cases that regressed"""
+    regressions = []
+    for case in sorted(set(old_results) & set(new_results)):
+        ratio = new_results[case]["mean"] / old_results[case]["mean"]
+        flag = ""
+        if ratio > REGRESSION_THRESHOLD:
+            flag = "  REGRESSION"
+            regressions.append(case)
+        print("{0:<40} {1:>10.3f}ms -> {2:>10.3f}ms  x{3:.2f}{4}".format(
+            case, old_results[case]["mean"] * 1000, new_results[case]["mean"] * 1000, ratio, flag))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark map generation and rendering")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_MAP_SIZES, help="Side lengths of the square maps to test")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--only", nargs="+", help="Only run the named benchmarks")
+    parser.add_argument("--out", help="Save results to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two saved result files instead of running")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as old_file, open(args.compare[1]) as new_file:
+            regressions = compare(json.load(old_file)["results"], json.load(new_file)["results"])
+        return 1 if regressions else 0
+
+    results = run(args.sizes, args.repeat, args.only)
+    if args.out:
+        with open(args.out, 'w') as out_file:
+            json.dump({"python": sys.version, "sizes": args.sizes, "results": results}, out_file, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,233 @@
+"""A map that is generated a chunk at a time, as it is looked at
+
+A ChunkedGamemap can be far bigger than memory. It is split into square chunks, and a chunk is
+only generated when something touches it. Chunks that haven't been touched in a while are thrown
+away once the map goes over its memory budget, and generated again if they are needed later.
+
+Every chunk gets its own random seed derived from the world seed and the chunk's coordinates,
+and only ever looks at the mesas of its immediate neighbors, so a chunk always comes out the
+same no matter which chunks were generated before it.
+"""
+import collections
+import random
+
+from patches import Mesa
+from tilemanager import TileManager
+from tilegrid import TileGrid, get_char_table
+from gamemap import build_walls, DirtyRegions
+
+class ChunkedGamemap(object):
+    """A lazily generated map, stored as an LRU cache of fixed-size chunks"""
+
+    mesa_max_radius = 6
+    mesa_map_density = .02
+
+    def __init__(self, width, height, seed=None, chunk_size=64, memory_budget=64*1024*1024):
+        """seed is a value or a random.Random instance, as for Gamemap.
+        memory_budget is roughly how many bytes of chunks to keep loaded.
+        """
+        #A mesa must never reach past the chunks next to the one it was placed in
+        if chunk_size < 2*self.mesa_max_radius + 2:
+            raise ValueError("chunk_size {0} is too small for mesas of radius {1}".format(chunk_size, self.mesa_max_radius))
+        self.height = height
+        self.width = width
+        self.map_area = height * width
+        if seed is None or isinstance(seed, random.Random):
+            #Chunk seeds are derived from a plain value, so draw one
+            seed = (seed or random).getrandbits(64)
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.max_chunks = max(1, memory_budget // (chunk_size * chunk_size))
+
+        #(chunk_x, chunk_y) -> TileGrid, least recently used first
+        self._chunks = collections.OrderedDict()
+        #(chunk_x, chunk_y) -> {index within chunk: tile code}
+        #Changes made with set(), replayed if an evicted chunk is generated again.
+        self._edits = collections.defaultdict(dict)
+        self.dirty_regions = DirtyRegions()
+        #Always the same view, so that GamePanel.display can tell it's still the same map
+        self._view = ChunkedMapView(self)
+
+    def get(self, x, y):
+        x, y = self._check_coords(x, y)
+        chunk = self._get_chunk(x // self.chunk_size, y // self.chunk_size)
+        return chunk.get(x % self.chunk_size, y % self.chunk_size)
+
+    def set(self, x, y, tile):
+        x, y = self._check_coords(x, y)
+        chunk_coords = (x // self.chunk_size, y // self.chunk_size)
+        local_x, local_y = x % self.chunk_size, y % self.chunk_size
+        self._get_chunk(*chunk_coords).set(local_x, local_y, tile)
+        self._edits[chunk_coords][local_y * self.chunk_size + local_x] = tile.code
+        self.dirty_regions.mark(x, y)
+
+    def get_map_array(self):
+        """Returns a view of the map that can be indexed as maparray[y][x], like Gamemap's.
+        Only the chunks that are actually read get generated. Every call returns the same view.
+        """
+        return self._view
+
+    def get_row_tiles(self, y, x_start, x_end):
+        """Returns a list of the tiles in row y from x_start up to but not including x_end"""
+        size = self.chunk_size
+        chunk_y, local_y = divmod(y, size)
+        tiles = []
+        x = x_start
+        while x < x_end:
+            chunk_x, local_x = divmod(x, size)
+            run = min(x_end - x, size - local_x)
+            chunk = self._get_chunk(chunk_x, chunk_y)
+            tiles.extend(chunk[local_y][local_x:local_x + run])
+            x += run
+        return tiles
+
+    def get_row_codes(self, y, x_start, x_end):
+        """Returns the tile codes of row y from x_start up to but not including x_end, as bytes"""
+        size = self.chunk_size
+        chunk_y, local_y = divmod(y, size)
+        codes = bytearray()
+        x = x_start
+        while x < x_end:
+            chunk_x, local_x = divmod(x, size)
+            run = min(x_end - x, size - local_x)
+            chunk = self._get_chunk(chunk_x, chunk_y)
+            codes += chunk.row_codes(local_y)[local_x:local_x + run]
+            x += run
+        return bytes(codes)
+
+    def loaded_chunk_count(self):
+        return len(self._chunks)
+
+    def _check_coords(self, x, y):
+        """Wraps negative coordinates like Gamemap does and raises IndexError if they're off the map"""
+        if x < 0:
+            x += self.width
+        if y < 0:
+            y += self.height
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError("list index out of range X:{0} Y:{1} Width:{2} Height:{3}".format(x, y, self.width, self.height))
+        return x, y
+
+    def _get_chunk(self, chunk_x, chunk_y):
+        """Returns the TileGrid for a chunk, generating it if it isn't loaded"""
+        key = (chunk_x, chunk_y)
+        chunk = self._chunks.get(key)
+        if chunk is not None:
+            self._chunks.move_to_end(key)
+            return chunk
+        chunk = self._generate_chunk(chunk_x, chunk_y)
+        for index, code in self._edits.get(key, {}).items():
+            chunk.set_code(index % self.chunk_size, index // self.chunk_size, code)
+        self._chunks[key] = chunk
+        while len(self._chunks) > self.max_chunks:
+            self._chunks.popitem(last=False)
+        return chunk
+
+    def _get_chunk_rng(self, chunk_x, chunk_y):
+        """Returns a random number generator seeded from the world seed and the chunk's coordinates"""
+        return random.Random("{0}/{1}/{2}".format(self.seed, chunk_x, chunk_y))
+
+    def _place_mesas(self, chunk_x, chunk_y):
+        """Returns the mesas whose top-left corners lie in the given chunk.
+
+        Mesas may spill over into the chunks to the right and below, but never off the map.
+        """
+        size = self.chunk_size
+        rng = self._get_chunk_rng(chunk_x, chunk_y)
+        mesas = []
+        total_mesa_area = 0
+        while (total_mesa_area/(size*size)) < self.mesa_map_density:
+            r = rng.randint(0, self.mesa_max_radius)
+            x = chunk_x * size + rng.randint(0, size-1)
+            y = chunk_y * size + rng.randint(0, size-1)
+            total_mesa_area += r**2
+            if x + 2*r + 1 <= self.width and y + 2*r + 1 <= self.height:
+                mesas.append(Mesa(x, y, r))
+        return mesas
+
+    def _generate_chunk(self, chunk_x, chunk_y):
+        """Rasterizes a chunk and builds its walls.
+
+        The chunk is drawn with a one tile apron around it, using the mesas from all
+        eight neighboring chunks, so walls along its edges match its neighbors'.
+        """
+        size = self.chunk_size
+        apron_x = chunk_x * size - 1
+        apron_y = chunk_y * size - 1
+        apron = TileGrid(size + 2, size + 2, TileManager.impass)
+        for neighbor_y in range(chunk_y - 1, chunk_y + 2):
+            for neighbor_x in range(chunk_x - 1, chunk_x + 2):
+                if neighbor_x < 0 or neighbor_y < 0:
+                    continue
+                for mesa in self._place_mesas(neighbor_x, neighbor_y):
+                    for tile, stencil in mesa.get_stencils():
+                        apron.blit_clipped(mesa.x - apron_x, mesa.y - apron_y, stencil, tile)
+        build_walls(apron, wrap_edges=False)
+        return apron.crop(1, 1, size, size)
+
+    def iter_lines(self):
+        """Yields the map as text, one row at a time, each line ending in a newline.
+        Chunks are loaded and evicted as usual along the way.
+        """
+        table = get_char_table(TileManager.palette)
+        for y in range(self.height):
+            if table is None:
+                yield "".join(tile.char for tile in self.get_row_tiles(y, 0, self.width)) + '\n'
+            else:
+                yield self.get_row_codes(y, 0, self.width).translate(table).decode('latin-1') + '\n'
+
+    def write_to(self, fileobj):
+        """Writes the map as text to a file opened in text mode, a row at a time"""
+        for line in self.iter_lines():
+            fileobj.write(line)
+
+    def __str__(self):
+        return "".join(self.iter_lines())
+
+
+class ChunkedMapView(object):
+    """A read-only, maparray[y][x] style view of a ChunkedGamemap"""
+
+    def __init__(self, gamemap):
+        self.gamemap = gamemap
+
+    def __len__(self):
+        return self.gamemap.height
+
+    def __getitem__(self, y):
+        if isinstance(y, slice):
+            return [ChunkedMapRow(self.gamemap, i_y) for i_y in range(*y.indices(self.gamemap.height))]
+        if y < 0:
+            y += self.gamemap.height
+        if not 0 <= y < self.gamemap.height:
+            raise IndexError("list index out of range")
+        return ChunkedMapRow(self.gamemap, y)
+
+    def __iter__(self):
+        for y in range(self.gamemap.height):
+            yield ChunkedMapRow(self.gamemap, y)
+
+
+class ChunkedMapRow(object):
+    """A read-only view of a single row of a ChunkedGamemap"""
+
+    def __init__(self, gamemap, y):
+        self.gamemap = gamemap
+        self.y = y
+
+    def __len__(self):
+        return self.gamemap.width
+
+    def __getitem__(self, x):
+        if isinstance(x, slice):
+            start, stop, step = x.indices(self.gamemap.width)
+            if start >= stop:
+                return []
+            return self.gamemap.get_row_tiles(self.y, start, stop)[::step]
+        return self.gamemap.get(x, self.y)
+
+    def __iter__(self):
+        size = self.gamemap.chunk_size
+        for x in range(0, self.gamemap.width, size):
+            for tile in self.gamemap.get_row_tiles(self.y, x, min(x + size, self.gamemap.width)):
+                yield tile
@@ -0,0 +1,174 @@
+"""Finding which parts of a map can be walked between
+
+Walkable tiles are labeled as horizontal runs rather than one at a time: each row is split into
+runs of walkable tiles, and runs that touch a run in the row above are merged with union-find.
+A map has far fewer runs than tiles, so this stays fast on very large maps.
+
+Runs are found a band of rows at a time with bytes.translate and bytes.split, so that finding
+them takes no Python code per run, only per band.
+"""
+import bisect
+from itertools import accumulate, chain
+
+from tilemanager import TileManager
+
+WALKABLE_TILES = (TileManager.floor, TileManager.bridge)
+#Rows translated to walkable/not walkable bytes at a time
+LABEL_BAND_HEIGHT = 256
+#What walkable and other tiles are translated to for splitting into runs
+WALKABLE = ord('x')
+SPACE = ord(' ')
+
+class Components(object):
+    """The connected regions of walkable tiles on a grid, as found by label_components.
+
+    Components are labeled 0 to count-1, in the order their first tiles appear reading
+    the grid row by row.
+    """
+
+    def __init__(self, width, height, row_offsets, run_starts, run_ends, run_roots, root_labels, count):
+        self.width = width
+        self.height = height
+        #Runs in row y are run_starts/run_ends/run_labels[row_offsets[y]:row_offsets[y+1]],
+        #with starts and ends as positions in the whole grid, y * width + x
+        self._row_offsets = row_offsets
+        self._run_starts = run_starts
+        self._run_ends = run_ends
+        #Each run's tree root is another run, and root_labels gives each root's label, so
+        #runs are only labeled when they're asked about rather than all of them up front
+        self._run_roots = run_roots
+        self._root_labels = root_labels
+        self._count = count
+        self._sizes = None
+
+    @property
+    def count(self):
+        return self._count
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def sizes(self):
+        """The number of tiles in each component, worked out the first time it's asked for"""
+        if self._sizes is None:
+            self._sizes = [0] * self._count
+            root_labels = self._root_labels
+            for root, start, end in zip(self._run_roots, self._run_starts, self._run_ends):
+                self._sizes[root_labels[root]] += end - start
+        return self._sizes
+
+    def is_connected(self):
+        """Returns whether every walkable tile can reach every other one"""
+        return self._count <= 1
+
+    def label_at(self, x, y):
+        """Returns the label of the component the tile at x, y is in, or None if it isn't walkable"""
+        first, last = self._row_offsets[y], self._row_offsets[y+1]
+        position = y * self.width + x
+        run = bisect.bisect_right(self._run_starts, position, first, last) - 1
+        if run >= first and position < self._run_ends[run]:
+            return self._root_labels[self._run_roots[run]]
+        return None
+
+
+def label_components(grid, walkable_tiles=WALKABLE_TILES):
+    """Labels the orthogonally connected regions of walkable tiles on a TileGrid.
+    Returns a Components.
+    """
+    width, height = grid.width, grid.height
+    walkable_codes = set(tile.code for tile in walkable_tiles)
+    #Walkable tiles become WALKABLE and the rest whitespace, so bytes.split() cuts a band
+    #into its runs in one call. Swapping the two gives the gaps between them.
+    runs_table = bytes(WALKABLE if code in walkable_codes else SPACE for code in range(256))
+    gaps_table = bytes(SPACE if code in walkable_codes else WALKABLE for code in range(256))
+
+    #Runs are kept as positions in the whole grid, y * width + x, so that they are in order
+    #from one row to the next
+    run_starts = []
+    run_ends = []
+    row_offsets = []
+    for band_start in range(0, height, LABEL_BAND_HEIGHT):
+        band_end = min(band_start + LABEL_BAND_HEIGHT, height)
+        codes = grid.read_rows(band_start, band_end)
+        cells = codes.translate(runs_table)
+        run_lengths = map(len, cells.split())
+        gap_lengths = map(len, codes.translate(gaps_table).split())
+        if cells[:1] == bytes((WALKABLE,)):
+            gap_lengths = chain((0,), gap_lengths)
+        #Alternating gaps and runs add up to the start and end of each run
+        band_first = len(run_starts)
+        edges = list(accumulate(chain.from_iterable(zip(gap_lengths, run_lengths)), initial=band_start * width))
+        run_starts += edges[1::2]
+        run_ends += edges[2::2]
+        #A run can carry on from the end of one row to the start of the next, which rarely
+        #happens, so split those afterwards
+        for row_start in range(width, len(cells), width):
+            if cells[row_start - 1] == WALKABLE and cells[row_start] == WALKABLE:
+                row_start += band_start * width
+                run = bisect.bisect_left(run_starts, row_start, band_first) - 1
+                run_ends.insert(run, row_start)
+                run_starts.insert(run + 1, row_start)
+        for y in range(band_start, band_end):
+            row_offsets.append(bisect.bisect_left(run_starts, y * width, band_first))
+    row_offsets.append(len(run_starts))
+
+    #Each run joins the tree of the first run above that it overlaps, or starts a tree of
+    #its own if there isn't one. Runs are numbered in order, so every tree's root is its
+    #earliest run. Trees are only merged afterwards, so that the common case of a run that
+    #carries straight on from the one above costs a few comparisons.
+    tree_roots = []
+    add_tree_root = tree_roots.append
+    new_roots = []
+    add_new_root = new_roots.append
+    merges = []
+    add_merge = merges.append
+    for y in range(height):
+        above = row_offsets[y-1] if y > 0 else 0
+        first, last = row_offsets[y], row_offsets[y+1]
+        #The row above's runs are followed by this row's, which all start after any run
+        #above could overlap, so the scans stop there without checking for the end
+        for run, start, end in zip(range(first, last), run_starts[first:last], run_ends[first:last]):
+            start -= width
+            end -= width
+            while run_ends[above] <= start:
+                above += 1
+            if run_starts[above] < end:
+                root = tree_roots[above]
+                #Any more runs above that it overlaps join their trees to this one
+                while run_ends[above] < end and run_starts[above + 1] < end:
+                    above += 1
+                    add_merge((root, tree_roots[above]))
+            else:
+                root = run
+                add_new_root(run)
+            add_tree_root(root)
+
+    #Union-find over the trees. A root is always the earliest tree in its component.
+    parents = {}
+    def find(root):
+        while root in parents:
+            parent = parents[root]
+            if parent in parents:
+                #Path halving
+                parents[root] = parent = parents[parent]
+            root = parent
+        return root
+    for root, root2 in merges:
+        root, root2 = find(root), find(root2)
+        if root < root2:
+            parents[root2] = root
+        elif root2 < root:
+            parents[root] = root2
+
+    #Roots are in order, so each component is labeled the first time its root comes up
+    root_labels = {}
+    count = 0
+    for root in new_roots:
+        if root in parents:
+            root_labels[root] = root_labels[find(root)]
+        else:
+            root_labels[root] = count
+            count += 1
+
+    return Components(width, height, row_offsets, run_starts, run_ends, tree_roots, root_labels, count)
@@ -1,21 +1,32 @@
 """This module holds creatures and stuff that moves around"""
 import events
-from tile import Tile
+from tilemanager import Tile
 
 import functools
 import itertools
 
-class Entity():
+class Entity(object):
     """A dynamic object on the map, such as a player or monster"""
+    #Slotted, since a world can hold a great many of these. __weakref__ lets them listen weakly.
+    __slots__ = ('tile', 'x', 'y', 'get_gameworld_cell', 'world', 'inventory', '__weakref__')
 
     def __init__(self, tile, x, y, get_gameworld_cell):
         self.tile = tile
         self.x = x
         self.y = y
         self.get_gameworld_cell = get_gameworld_cell
+        #The GameWorld this entity has been added to, if any
+        self.world = None
 
         self.inventory = []
 
+    def set_position(self, x, y):
+        """Move to x, y, keeping the world's index of entities up to date"""
+        if self.world is not None:
+            self.world.move_entity(self, x, y)
+        else:
+            self.x, self.y = x, y
+
     def player_collision(self, player):
         """Called when the player attempts to enter the same cell as this entity
 
@@ -23,12 +34,21 @@ class Entity():
         """
         return True
 
+    def on_player_enter_space(self, player, x, y):
+        """Called when the player is about to enter a cell near this entity, if it's
+        listening (see GameWorld.listen_nearby)
+
+        Trigger "player_should_stop" to keep the player out.
+        """
+        pass
+
     def die(self):
         """Remove this entity from the world"""
         events.trigger_event("on_entity_death", self)
 
 class Player(Entity):
     """A player character"""
+    __slots__ = ('should_move', 'subscriptions')
 
     def __init__(self, *args, **kwargs):
         tile = Tile('@', foreground="WHITE", background="CYAN")
@@ -38,11 +58,19 @@ class Player(Entity):
         #prevents the player from moving
         self.should_move = True 
 
-        events.listen_to_event("player_move", self.move)
-        events.listen_to_event("player_should_stop", self.cancel_move)
-        events.listen_to_event("player_display_inventory", self.display_inventory)
-        events.listen_to_event("player_drop_inventory", self.drop_inventory)
-        events.listen_to_event("player_use_portal", self.use_portal)
+        #Listen weakly, so that a player nobody else refers to anymore can be collected
+        self.subscriptions = [
+            events.listen_to_event("player_move", self.move, weak=True),
+            events.listen_to_event("player_should_stop", self.cancel_move, weak=True),
+            events.listen_to_event("player_display_inventory", self.display_inventory, weak=True),
+            events.listen_to_event("player_drop_inventory", self.drop_inventory, weak=True),
+            events.listen_to_event("player_use_portal", self.use_portal, weak=True),
+        ]
+
+    def stop_listening(self):
+        """Unsubscribe from all the player events, so this player stops responding to input"""
+        for subscription in self.subscriptions:
+            subscription.remove()
 
     def move(self, x_dir, y_dir):
         """Check the map and move the player in the given direction
@@ -60,12 +88,18 @@ class Player(Entity):
         for thingy in thingies:
             self.should_move = (thingy.player_collision(self) and self.should_move)
 
-        #Then we trigger an event for anyone not in the next cell who might care
-        #If they stop us from moving, they should trigger "player_should_stop"
-        events.trigger_event("player_enter_space", self, *next_coords)
+        #Then we tell anyone not in the next cell who might care. Entities that do register
+        #with GameWorld.listen_nearby, so only the ones near the next cell hear about it,
+        #rather than every subscriber on every step. If they stop us from moving, they
+        #should trigger "player_should_stop"
+        if self.world is not None:
+            self.world.trigger_enter_space(self, *next_coords)
 
         if self.should_move:
-            self.x, self.y = next_coords
+            old_coords = (self.x, self.y)
+            self.set_position(*next_coords)
+            #Nothing needs to hear about this until the screen is redrawn
+            events.defer_event("entity_moved", self, *old_coords)
 
     def cancel_move(self):
         """Stop an in-progress movement
@@ -118,6 +152,7 @@ class ItemPickup(Entity):
     When the player walks over it, they pick it up, which puts its inventory items
     in their inventory and destroys this object.
     """
+    __slots__ = ()
 
     def __init__(self, items, *args, **kwargs):
         tile = Tile('%', foreground="YELLOW", background="BLACK", bold=True)
@@ -134,6 +169,7 @@ class ItemPickup(Entity):
 
 class Signpost(Entity):
     """An entity that displays a message when the player bumps into it"""
+    __slots__ = ('message', 'let_player_through')
 
     def __init__(self, message, *args, **kwargs):
         super(Signpost, self).__init__(*args, **kwargs)
@@ -1,20 +1,127 @@
 """A module for event handling
 
 Objects register themselves to arbitrary string event names, which they pass callback functions to.
+Listening returns a Subscription, which can be removed again. Listeners can also be held weakly,
+so that listening to an event doesn't keep an object alive.
+
+Events fire immediately with trigger_event, or can be queued with defer_event and fired in a
+batch later by process_deferred_events, which the game loop calls once per tick.
 """
-from collections import defaultdict
+import collections
+import weakref
+
+import profiling
+
+class Subscription(object):
+    """A handle on a callback listening to an event"""
+
+    def __init__(self, bus, eventname, callback, weak=False):
+        self.bus = bus
+        self.eventname = eventname
+        self.active = True
+        if weak:
+            #Bound methods are created fresh on every attribute access, so they need a WeakMethod
+            ref_type = weakref.WeakMethod if hasattr(callback, "__self__") else weakref.ref
+            self._ref = ref_type(callback, lambda ref: self.remove())
+            self._dispatch = self._call_weak
+        else:
+            self._ref = None
+            self._dispatch = callback
+
+    def remove(self):
+        """Stop listening. Removing a subscription twice does nothing."""
+        if self.active:
+            self.active = False
+            self.bus._remove(self)
+
+    def _call_weak(self, *args, **kwargs):
+        callback = self._ref()
+        if callback is not None:
+            callback(*args, **kwargs)
+
+
+class EventBus(object):
+    """Event names, the callbacks listening to them, and a queue of deferred events"""
+
+    def __init__(self):
+        #eventname -> tuple of Subscriptions. Tuples are replaced rather than changed, so
+        #listeners can come and go while an event is being dispatched. Changes take effect
+        #from the next event on.
+        self._listeners = {}
+        #Events waiting for process_deferred, as (eventname, args, kwargs)
+        self._deferred = collections.deque()
+
+    def listen(self, eventname, callback, weak=False):
+        """Register callback to be called whenever eventname fires. Returns a Subscription.
+
+        If weak is True, the bus only holds a weak reference to callback (or, for a bound method,
+        to the object it's bound to), and the subscription goes away when that's garbage collected.
+        """
+        subscription = Subscription(self, eventname, callback, weak)
+        self._listeners[eventname] = self._listeners.get(eventname, ()) + (subscription,)
+        return subscription
 
-__event_listeners = defaultdict(list)
+    def trigger(self, eventname, *args, **kwargs):
+        """Call all the callbacks listening to eventname, right now"""
+        with profiling.phase("event", eventname):
+            for subscription in self._listeners.get(eventname, ()):
+                subscription._dispatch(*args, **kwargs)
 
-def listen_to_event(eventname, callback):
+    def defer(self, eventname, *args, **kwargs):
+        """Queue eventname to be triggered by the next process_deferred call"""
+        self._deferred.append((eventname, args, kwargs))
+
+    def process_deferred(self):
+        """Trigger the events queued so far, in order. Events deferred by their callbacks wait
+        for the next call, so this always finishes. Returns the number of events triggered.
+        """
+        count = len(self._deferred)
+        popleft = self._deferred.popleft
+        listeners = self._listeners
+        phase = profiling.phase
+        for i in range(count):
+            eventname, args, kwargs = popleft()
+            with phase("event", eventname):
+                for subscription in listeners.get(eventname, ()):
+                    subscription._dispatch(*args, **kwargs)
+        return count
+
+    def listener_count(self, eventname):
+        return len(self._listeners.get(eventname, ()))
+
+    def _remove(self, subscription):
+        remaining = tuple(other for other in self._listeners.get(subscription.eventname, ()) if other is not subscription)
+        if remaining:
+            self._listeners[subscription.eventname] = remaining
+        else:
+            self._listeners.pop(subscription.eventname, None)
+
+
+#The bus the module-level functions use
+__event_bus = EventBus()
+
+def get_event_bus():
+    return __event_bus
+
+def listen_to_event(eventname, callback, weak=False):
     """Register an object to listen to an event
 
     eventname: A string identifying the event to listen for
     callback: A function to be called on listening_object when the event fires
+    weak: If True, don't keep callback's object alive just so it can listen
+
+    Returns a Subscription, whose remove() method stops listening.
     """
-    __event_listeners[eventname].append(callback)
+    return __event_bus.listen(eventname, callback, weak)
 
 def trigger_event(eventname, *args, **kwargs):
     """Call all the registered callbacks that are listening to eventname"""
-    for callback in __event_listeners[eventname]:
-        callback(*args, **kwargs)
+    __event_bus.trigger(eventname, *args, **kwargs)
+
+def defer_event(eventname, *args, **kwargs):
+    """Queue an event to be triggered on the next process_deferred_events call"""
+    __event_bus.defer(eventname, *args, **kwargs)
+
+def process_deferred_events():
+    """Trigger every event queued with defer_event, in order. Returns how many there were."""
+    return __event_bus.process_deferred()
@@ -0,0 +1,211 @@
+"""Field of view: which map cells can be seen from where
+
+Visibility is found by recursive shadowcasting over an opacity grid, one byte per map cell,
+kept in step with the map. Results are cached per origin and radius, and a change to the
+map only throws away the cached results it could affect.
+"""
+import collections
+
+from tilemanager import TileManager
+
+#Tiles that can't be seen past
+OPAQUE_TILES = (TileManager.wall, TileManager.impass)
+#How many (origin, radius) results to keep
+FOV_CACHE_SIZE = 64
+
+#Multipliers that map each of the eight octants onto the first: (xx, xy, yx, yy)
+_OCTANTS = ((1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+            (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1))
+
+class VisibleArea(object):
+    """The cells visible from an origin, out to a radius.
+
+    Stored as a (2*radius+1) square mask of bytes centered on the origin, 1 where the cell
+    is visible. Cells off the map are never visible.
+    """
+
+    def __init__(self, origin_x, origin_y, radius, mask):
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.radius = radius
+        self.left = origin_x - radius
+        self.top = origin_y - radius
+        self.size = 2*radius + 1
+        self._mask = mask
+
+    def is_visible(self, x, y):
+        local_x = x - self.left
+        local_y = y - self.top
+        if 0 <= local_x < self.size and 0 <= local_y < self.size:
+            return self._mask[local_y * self.size + local_x] == 1
+        return False
+
+    def row_mask(self, y, x_start, x_end):
+        """Returns bytes with one byte per cell from x_start up to x_end in row y,
+        1 if the cell is visible and 0 if not
+        """
+        local_y = y - self.top
+        if not 0 <= local_y < self.size or x_end <= self.left or x_start >= self.left + self.size:
+            return bytes(x_end - x_start)
+        row_start = local_y * self.size
+        first = max(x_start, self.left)
+        last = min(x_end, self.left + self.size)
+        return (bytes(first - x_start) + self._mask[row_start + first - self.left:row_start + last - self.left]
+                + bytes(x_end - last))
+
+    def box(self):
+        """Returns the (x, y, width, height) box the area could cover"""
+        return (self.left, self.top, self.size, self.size)
+
+
+class FieldOfView(object):
+    """Works out what's visible on a Gamemap, and remembers everything that has been seen"""
+
+    def __init__(self, gamemap, opaque_tiles=OPAQUE_TILES, cache_size=FOV_CACHE_SIZE):
+        self.gamemap = gamemap
+        self.width = gamemap.width
+        self.height = gamemap.height
+        self._opacity_table = bytes(1 if code in set(tile.code for tile in opaque_tiles) else 0 for code in range(256))
+        grid = gamemap.get_map_array()
+        self._opacity = bytearray(grid.read_rows(0, grid.height).translate(self._opacity_table))
+        #1 for every cell that has ever been visible
+        self._seen = bytearray(self.width * self.height)
+        self._cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        #The VisibleArea from the latest compute()
+        self.visible = None
+        gamemap.add_change_listener(self.invalidate)
+
+    def compute(self, x, y, radius):
+        """Returns the VisibleArea seen from x, y out to radius, and remembers it as seen"""
+        key = (x, y, radius)
+        area = self._cache.get(key)
+        if area is None:
+            area = self._cast(x, y, radius)
+            self._cache[key] = area
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        if area is not self.visible:
+            self._remember(area)
+            self.visible = area
+        return area
+
+    def is_remembered(self, x, y):
+        return self._seen[y * self.width + x] == 1
+
+    def row_states(self, y, x_start, x_end):
+        """Returns bytes with one byte per cell from x_start up to x_end in row y:
+        2 if the cell is visible now, 1 if it's been seen before, and 0 if it never has
+        """
+        row_start = y * self.width
+        seen = self._seen[row_start + x_start:row_start + x_end]
+        if self.visible is None:
+            return bytes(seen)
+        visible = self.visible.row_mask(y, x_start, x_end)
+        #Visible cells have always been seen, so adding gives 2 for those without any carries
+        return (int.from_bytes(seen, 'big') + int.from_bytes(visible, 'big')).to_bytes(x_end - x_start, 'big')
+
+    def invalidate(self, x, y, width, height):
+        """Called when a region of the map changes: updates the opacity grid, and forgets
+        cached results that could see into the region
+        """
+        grid = self.gamemap.get_map_array()
+        left = max(x, 0)
+        right = min(x + width, self.width)
+        top = max(y, 0)
+        bottom = min(y + height, self.height)
+        if left >= right or top >= bottom:
+            return
+        for row in range(top, bottom):
+            start = row * self.width
+            self._opacity[start + left:start + right] = grid.row_codes(row)[left:right].translate(self._opacity_table)
+        for key, area in list(self._cache.items()):
+            if (area.left < right and left < area.left + area.size and
+                    area.top < bottom and top < area.top + area.size):
+                del self._cache[key]
+
+    def _remember(self, area):
+        for local_y in range(area.size):
+            y = area.top + local_y
+            if not 0 <= y < self.height:
+                continue
+            left = max(area.left, 0)
+            right = min(area.left + area.size, self.width)
+            if left >= right:
+                continue
+            row_start = y * self.width
+            visible = area.row_mask(y, left, right)
+            seen = self._seen[row_start + left:row_start + right]
+            self._seen[row_start + left:row_start + right] = (int.from_bytes(seen, 'big') | int.from_bytes(visible, 'big')).to_bytes(right - left, 'big')
+
+    def _cast(self, origin_x, origin_y, radius):
+        """Shadowcasts all eight octants around origin_x, origin_y. Returns a VisibleArea."""
+        size = 2*radius + 1
+        mask = bytearray(size * size)
+        if 0 <= origin_x < self.width and 0 <= origin_y < self.height:
+            mask[radius * size + radius] = 1
+            #Away from the edges of the map, there's no need to check every cell is on it
+            inside = (radius <= origin_x < self.width - radius and radius <= origin_y < self.height - radius)
+            for octant in _OCTANTS:
+                self._cast_octant(origin_x, origin_y, radius, mask, inside, 1, 1.0, 0.0, octant)
+        return VisibleArea(origin_x, origin_y, radius, mask)
+
+    def _cast_octant(self, origin_x, origin_y, radius, mask, inside, first_row, start_slope, end_slope, octant):
+        """Lights one octant from first_row outward, between two slopes, recursing around blockers.
+
+        Within the octant, rows run away from the origin and each row is scanned from dx = -row
+        to 0. The octant's multipliers map (dx, dy) onto the map.
+        """
+        if start_slope < end_slope:
+            return
+        xx, xy, yx, yy = octant
+        opacity = self._opacity
+        width = self.width
+        height = self.height
+        size = 2*radius + 1
+        radius_squared = radius * radius + radius
+        #How far along the map and the mask one step of dx moves
+        map_step = yx * width + xx
+        mask_step = yx * size + xx
+        new_start = 0.0
+        for distance in range(first_row, radius + 1):
+            blocked = False
+            dy = -distance
+            #Cells further left than this are outside the circle
+            lit_dx = -int((radius_squared - dy * dy) ** .5)
+            left_divisor = 1 / (dy + .5)
+            right_divisor = 1 / (dy - .5)
+            map_x = origin_x - distance * xx + dy * xy
+            map_y = origin_y - distance * yx + dy * yy
+            map_index = map_y * width + map_x
+            mask_index = (dy * yy - distance * yx + radius) * size + dy * xy - distance * xx + radius
+            for dx in range(-distance, 1):
+                right_slope = (dx + .5) * right_divisor
+                if start_slope >= right_slope:
+                    left_slope = (dx - .5) * left_divisor
+                    if end_slope > left_slope:
+                        break
+                    if inside or (0 <= map_x < width and 0 <= map_y < height):
+                        opaque = opacity[map_index]
+                        if dx >= lit_dx:
+                            mask[mask_index] = 1
+                    else:
+                        opaque = 1
+                    if blocked:
+                        if opaque:
+                            new_start = right_slope
+                        else:
+                            blocked = False
+                            start_slope = new_start
+                    elif opaque and distance < radius:
+                        blocked = True
+                        self._cast_octant(origin_x, origin_y, radius, mask, inside, distance + 1, start_slope, left_slope, octant)
+                        new_start = right_slope
+                map_index += map_step
+                mask_index += mask_step
+                map_x += xx
+                map_y += yx
+            if blocked:
+                break
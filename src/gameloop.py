@@ -0,0 +1,147 @@
+"""The game's main loop, run on asyncio
+
+Input, the world tick and drawing are separate tasks, so none of them holds up the others.
+Keys are read without blocking, the world ticks at a fixed rate whether or not anything is
+pressed, and the screen is drawn at most once a frame however many things asked for it.
+Panels that need a keypress await one rather than blocking the whole program, and other work,
+such as generating chunks or autosaving, can run alongside with spawn() or run_in_thread().
+"""
+import asyncio
+import functools
+
+import events
+import keyinput
+import profiling
+
+#World ticks per second
+TICK_RATE = 10
+#Most frames drawn per second
+FRAME_RATE = 60
+#Most ticks run back to back to catch up after a stall. Any more missed than this are skipped.
+MAX_CATCHUP_TICKS = 5
+
+class GameLoop(object):
+    """Runs the game: hands keys to handle_key, calls tick at a fixed rate, and calls draw
+    when the screen needs redrawing.
+
+    tick is called with the number of the tick, and returns whether the screen needs redrawing.
+    """
+
+    def __init__(self, key_input, draw, tick=None, handle_key=keyinput.handle_key,
+                 tick_rate=TICK_RATE, frame_rate=FRAME_RATE):
+        self.keys = key_input
+        self._draw = draw
+        self._tick = tick
+        self._handle_key = handle_key
+        self.tick_interval = 1 / tick_rate
+        #No frame rate means drawing as soon as asked, as for a headless replay
+        self.frame_interval = 1 / frame_rate if frame_rate else 0
+        self.tick_count = 0
+        self.frame_count = 0
+        #Events are made once the loop is running, so they belong to the right event loop
+        self._redraw = None
+        self._stopped = None
+        self._redraw_requested = False
+        self._tasks = set()
+        #The first exception raised by a task, which stops the loop
+        self._error = None
+
+    def request_redraw(self):
+        """Have the screen drawn on the next frame. Any number of requests before then
+        make for one draw.
+        """
+        self._redraw_requested = True
+        if self._redraw is not None:
+            self._redraw.set()
+
+    @property
+    def redraw_pending(self):
+        """Whether a redraw has been asked for but not yet drawn"""
+        return self._redraw_requested
+
+    def spawn(self, coroutine):
+        """Runs a coroutine alongside the game. Returns its Task, which is cancelled when
+        the game stops. If it raises an exception, the game stops and run() raises it.
+        """
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def run_in_thread(self, func, *args, **kwargs):
+        """Runs a blocking function in a worker thread. Returns a future to await its result."""
+        return asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    def stop(self):
+        """Make run() return"""
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def run(self):
+        """Runs the game until stop() is called"""
+        self._redraw = asyncio.Event()
+        self._stopped = asyncio.Event()
+        if self._redraw_requested:
+            self._redraw.set()
+        self.spawn(self.keys.run())
+        self.spawn(self._handle_input())
+        self.spawn(self._tick_world())
+        self.spawn(self._render())
+        self.request_redraw()
+        try:
+            await self._stopped.wait()
+        finally:
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if self._error is not None:
+            raise self._error
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None and self._error is None:
+            self._error = task.exception()
+            self.stop()
+
+    async def _handle_input(self):
+        while True:
+            key = await self.keys.get_key()
+            with profiling.phase("handle_key"):
+                self._handle_key(key)
+            with profiling.phase("deferred_events"):
+                events.process_deferred_events()
+            self.request_redraw()
+            #Give anything the key woke up, such as a menu, the chance to start waiting for
+            #keys itself before the next one is handled
+            await asyncio.sleep(0)
+
+    async def _tick_world(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + self.tick_interval
+        while True:
+            await asyncio.sleep(max(next_tick - loop.time(), 0))
+            for i in range(MAX_CATCHUP_TICKS):
+                if next_tick > loop.time():
+                    break
+                self.tick_count += 1
+                with profiling.phase("tick"):
+                    needs_redraw = self._tick is not None and self._tick(self.tick_count)
+                    deferred_count = events.process_deferred_events()
+                if deferred_count or needs_redraw:
+                    self.request_redraw()
+                next_tick += self.tick_interval
+            if next_tick <= loop.time():
+                #Too far behind to catch up, so skip the ticks missed rather than rush through them
+                next_tick = loop.time() + self.tick_interval
+
+    async def _render(self):
+        while True:
+            await self._redraw.wait()
+            self._redraw.clear()
+            self._redraw_requested = False
+            with profiling.phase("frame"):
+                self._draw()
+            self.frame_count += 1
+            #Requests made while waiting out the rest of the frame are drawn together after it
+            await asyncio.sleep(self.frame_interval)
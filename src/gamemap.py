@@ -1,53 +1,235 @@
+import concurrent.futures
 import random
 import math
 
-from patches import Mesa, Bridge
+from patches import Mesa, Bridge, get_mesa_stencil
 from tilemanager import TileManager
+from tilegrid import TileGrid
+from spatialindex import PatchIndex
+from router import BridgeRouter, path_to_segments
+from connectivity import label_components
+from placement import place_mesas
+
+#Height of the horizontal bands the map is split into for parallel generation.
+#It's fixed, rather than based on the number of workers, so that the map only depends on the seed.
+GENERATION_BAND_HEIGHT = 256
+#Past this many changed regions between redraws, just treat the whole map as changed
+MAX_DIRTY_RECTS = 256
+
+class DirtyRegions(object):
+    """Keeps track of which parts of a map have changed since it was last drawn"""
+
+    def __init__(self):
+        #(x, y, width, height) regions, or None if everything needs redrawing
+        self._rects = None
+
+    def mark(self, x, y, width=1, height=1):
+        """Record that a region of the map has changed"""
+        if self._rects is None:
+            return
+        if len(self._rects) >= MAX_DIRTY_RECTS:
+            self._rects = None
+        else:
+            self._rects.append((x, y, width, height))
+
+    def mark_all(self):
+        self._rects = None
+
+    def has_changes(self):
+        """Returns whether anything has changed since the last take()"""
+        return self._rects is None or len(self._rects) > 0
+
+    def take(self):
+        """Returns the list of (x, y, width, height) regions changed since the last call,
+        or None if the whole map should be redrawn.
+        """
+        rects = self._rects
+        self._rects = []
+        return rects
+
 
 class Gamemap(object):
 
-    def __init__(self, width, height):
+    mesa_max_radius = 6
+    mesa_map_density = .02
+    #If False, _create_map_default won't place mesas whose bounding boxes overlap
+    allow_mesa_overlap = True
+    #If True, randomly placed mesas are bridged together (see connect_mesas). Off by default so
+    #that a seed keeps giving the map it always has. The poisson and bsp layouts are always
+    #joined up.
+    connect_islands = False
+
+    def __init__(self, width, height, seed=None, workers=None, layout="default"):
+        """seed is either a value to seed a new random.Random with, or a random.Random instance
+        to draw from. The same seed always generates the same map. Generation never touches
+        the global random module, so several maps can be generated at once.
+
+        If workers is set, the map is generated in bands across that many processes instead.
+        Banded maps differ from the default layout, but for a given seed are the same for any
+        number of workers. Only the default layout can be generated in bands; setting workers
+        with any other layout raises ValueError.
+
+        layout is "default" for randomly scattered mesas, "poisson" for evenly spread mesas
+        that never overlap, cover exactly mesa_map_density of the map (see placement.py) and
+        are all joined up with bridges, or "bsp" for mesas laid out by binary space
+        partitioning and all joined up with bridges.
+        """
         self.height = height
         self.width = width
         self.map_area = height * width
 
-        self._maparray = [[TileManager.impass for i in range(self.width)]for j in range(self.height)]
+        if isinstance(seed, random.Random):
+            self.rng = seed
+            self.seed = None
+        else:
+            self.rng = random.Random(seed)
+            self.seed = seed
+        if workers is not None and layout != "default":
+            raise ValueError("Only the default layout can be generated with workers, not {0}".format(layout))
+        self.workers = workers
+        self.layout = layout
+
+        self._maparray = TileGrid(self.width, self.height, TileManager.impass)
         self._mesas = []
         self._bridges = []
+        #Spatial indexes over the bounding boxes of everything in _mesas and _bridges
+        self._mesa_index = PatchIndex()
+        self._bridge_index = PatchIndex()
+        self.dirty_regions = DirtyRegions()
+        #Callbacks taking (x, y, width, height), called whenever a region of the map changes
+        self._change_listeners = []
         self._create_map()
 
+    @classmethod
+    def from_grid(cls, maparray, mesas=(), bridges=(), seed=None):
+        """Returns a Gamemap wrapping an existing TileGrid, such as a loaded map, without generating anything"""
+        gamemap = cls.__new__(cls)
+        gamemap.height = maparray.height
+        gamemap.width = maparray.width
+        gamemap.map_area = maparray.height * maparray.width
+        gamemap.rng = random.Random(seed)
+        gamemap.seed = seed
+        gamemap.workers = None
+        gamemap.layout = None
+        gamemap._maparray = maparray
+        gamemap._mesas = []
+        gamemap._bridges = []
+        gamemap._mesa_index = PatchIndex()
+        gamemap._bridge_index = PatchIndex()
+        for mesa in mesas:
+            gamemap._add_mesa(mesa)
+        for bridge in bridges:
+            gamemap._add_bridge(bridge)
+        gamemap.dirty_regions = DirtyRegions()
+        gamemap._change_listeners = []
+        return gamemap
+
     def get(self, x, y):
-        return self._maparray[y][x]
+        return self._maparray.get(x, y)
 
     def set(self, x, y, tile):
         try:
-            self._maparray[y][x] = tile
+            self._maparray.set(x, y, tile)
         except IndexError as e:
             raise IndexError(e.args[0] + " X:{0} Y:{1} Width:{2} Height:{3}".format(x, y, self.width, self.height))
+        self._mark_changed(x % self.width, y % self.height)
+
+    def add_change_listener(self, callback):
+        """Have callback(x, y, width, height) called whenever a region of the map changes"""
+        self._change_listeners.append(callback)
+
+    def remove_change_listener(self, callback):
+        self._change_listeners.remove(callback)
+
+    def _mark_changed(self, x, y, width=1, height=1):
+        self.dirty_regions.mark(x, y, width, height)
+        for listener in self._change_listeners:
+            listener(x, y, width, height)
 
     def _create_map(self):
-        self._create_map_default()
-        # self._create_map_bsp(0, 0, self.width-1, self.height-1)
+        if self.layout == "bsp":
+            self._router = BridgeRouter(self._maparray)
+            self._create_map_bsp(0, 0, self.width-1, self.height-1)
+            #Let go of the router's buffers
+            self._router = None
+            self._build_mesa_walls()
+        elif self.layout == "poisson":
+            self._create_map_poisson()
+        elif self.layout != "default":
+            raise ValueError("Unknown map layout {0}".format(self.layout))
+        elif self.workers is None:
+            self._create_map_default()
+        else:
+            self._create_map_parallel()
 
     def _create_map_default(self):
         # num_mesas = 5
-        mesa_max_radius = 6
-        mesa_map_density = .02
+        mesa_max_radius = self.mesa_max_radius
+        mesa_map_density = self.mesa_map_density
         # for i in range(num_mesas):
         total_mesa_area = 0
-        #Slop: Mesas can overlap or fall off the edge of the map.
+        #Slop: Mesas can overlap (unless allow_mesa_overlap is off) or fall off the edge of the map.
         #We might also have a large mesa that increases mesa density past the cutoff.
+        rejections = 0
         while (total_mesa_area/self.map_area) < mesa_map_density:
-            r = random.randint(0, mesa_max_radius)
-            y = random.randint(0, self.height-(2*r + 1))
-            x = random.randint(0, self.width-(2*r + 1))
+            r = self.rng.randint(0, mesa_max_radius)
+            y = self.rng.randint(0, self.height-(2*r + 1))
+            x = self.rng.randint(0, self.width-(2*r + 1))
+            if not self.allow_mesa_overlap and self._mesa_index.query_range(x, y, 2*r + 1, 2*r + 1):
+                #Give up if the map is too crowded to fit any more mesas in
+                rejections += 1
+                if rejections >= 1000:
+                    break
+                continue
+            rejections = 0
             self.make_mesa(x, y, r)
             mesa_area = r**2
             total_mesa_area += mesa_area
         # self.test_mesas()
 
+        if self.connect_islands:
+            self.connect_mesas()
+        self._build_mesa_walls()
+
+    def _create_map_poisson(self):
+        mesas, _ = place_mesas(self.rng, self.width, self.height, self.mesa_max_radius, self.mesa_map_density)
+        for x, y, r in mesas:
+            self.make_mesa(x, y, r)
+
+        #Mesas placed this way never touch, so unlike the default layout every one of them
+        #starts out as an island, and they're always joined up whatever connect_islands says
+        self.connect_mesas()
+        self._build_mesa_walls()
+
+    def _create_map_parallel(self):
+        """Generates the map like _create_map_default, but band by band in a process pool.
+
+        Each band places its own mesas with a generator seeded from the map seed and the band's
+        index, then the bands are stitched together and walled as a whole.
+        """
+        #Bands seed their own generators from a plain value
+        band_seed = self.rng.getrandbits(64) if self.seed is None else self.seed
+        band_count = (self.height + GENERATION_BAND_HEIGHT - 1) // GENERATION_BAND_HEIGHT
+        band_args = [(self.width, self.height, band_seed, band, self.mesa_max_radius, self.mesa_map_density)
+                        for band in range(band_count)]
+        if self.workers <= 1:
+            results = map(_rasterize_band, band_args)
+            self._stitch_bands(results)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+                self._stitch_bands(pool.map(_rasterize_band, band_args))
+
+        if self.connect_islands:
+            self.connect_mesas()
         self._build_mesa_walls()
-    
+
+    def _stitch_bands(self, results):
+        """Copies rasterized bands into the map, in order, and collects their mesas"""
+        for band, (mesas, band_codes) in enumerate(results):
+            self._maparray.write_rows(band * GENERATION_BAND_HEIGHT, band_codes)
+            for x, y, r in mesas:
+                self._add_mesa(Mesa(x, y, r))
+
     def _create_map_bsp(self, x, y, width, height, iter=0):
         # http://roguecentral.org/doryen/articles/bsp-dungeon-generation/
         margin = 4
@@ -55,15 +237,15 @@ class Gamemap(object):
         if width <= 2*margin and height <= 2*margin or iter >= max_iters:
             #End case
             #Build mesa
-            mesa_x = random.randint(x, (x + width)-1)
-            mesa_y = random.randint(y, (y + height)-1)
+            mesa_x = self.rng.randint(x, (x + width)-1)
+            mesa_y = self.rng.randint(y, (y + height)-1)
             maxradius = (min((x+width) - mesa_x, (y+height) - mesa_y)-1)//2
-            mesa_r = 0 if maxradius <= 0 else random.randint(0, maxradius)
+            mesa_r = 0 if maxradius <= 0 else self.rng.randint(0, maxradius)
 
             new_mesa = Mesa(mesa_x, mesa_y, mesa_r)
             if new_mesa.x + new_mesa.width >= self.width or new_mesa.y + new_mesa.height >= self.height:
                 raise IndexError("Mesa X:{0} Mesa Y{1} Mesa R:{2} \n{3}".format( mesa_x, mesa_y, mesa_r, new_mesa.dbgoutput()))
-            self._mesas.append(new_mesa)
+            self._add_mesa(new_mesa)
             self.apply_patch(new_mesa)
             return [new_mesa]
         else:
@@ -84,91 +266,48 @@ class Gamemap(object):
             mesas_a = self._create_map_bsp(x1, y1, new_width_1, new_height_1, iter + 1)
             mesas_b = self._create_map_bsp(x2, y2, new_width_2, new_height_2, iter + 1)
 
-            #Join the two partitions via a bridge
-            #I need to find a pair of mesas, one in each partition, that are orthogonally colinear
-            #and that don't have mesas between them.
-            #For the first condition, I have that solved.
-            #For the second, I can check the other mesas' bounding boxes
-            #against a box around mesa a and mesa b.
-            #BSP is great for making sure my graph is fully connected, but
-            #not so great for precomputing any of this stuff, alas.
-            m1 = random.choice(mesas_a)
-            m2 = random.choice(mesas_b)
-            #What if the partitions have no colinear mesas? This is extremely likely.
-            #I could make a new mesa. Problem: Then I break the whole point of having BSP.
-            #I could connect them with a Z, which is what the source website says to do. <-Let's do this one.
-            #I could move the mesas. That might make everthing too "griddy"
-            def _get_terminal_point(mesa, side):
-                axis = 0 if side in ['E', 'W'] else 0
-                invert = side in ['N', 'W']
-                offset_from_center = random.randint(-mesa.r, mesa.r)
-                point = mesa.get_edge_coordinates(offset_from_center, axis, invert)
-                return point
-
-            start_point = _get_terminal_point(m1, 'S' if split_dir == 'h' else 'E')
-            end_point = _get_terminal_point(m2, 'N' if split_dir == 'h' else 'W')
-
-            #TEST
-            # self.set(*start_point, tile=TileManager.test_1)
-            # self.set(*end_point, tile=TileManager.test_2)
-
-            #Translate into h-split space:
-            if split_dir == 'v':
-                start_point = (start_point[1], start_point[0])
-                end_point = (end_point[1], end_point[0])
-
-            bridge_endpoints = [start_point]
-            point = list(start_point)
-
-            step_dirs = {'N': (0, -1),
-                        'E': (1, 0),
-                        'S': (0, 1),
-                        'W': (-1, 0)}
-            direction = 'S'
-            next_point = point + step_dirs[direction]
-            stuck_direction_reserve = ['E', 'N', 'W', 'S']
-            while bridge_endpoints[-1] != end_point:
-                
-                #Keep going forward until I hit a wall, the halfway point, or colinearity.
-                #When I bend, bend in the direction of "forward" if possible
-                #Got to ensure that end_point isn't totally blocked by a mesa
-                #Possibly also make new mesas when I bend?
-
-                #Okay, how about this: Draw a line from start to min(dist to end/2, edge of nearest mesabox)
-                #Then turn and repeat, but don't do the /2 bit, until we get there.
-                #Finding the nearest mesa will be a bit of a butt, though.
-                #Maybe combine the 2: Define a Z, then walk along it until a mesa is hit, and if so, back up ~2-3 spaces and try again
-                #with a bend there?
-
-                #Maybe build simultaneously from both sides and stop when they meet?
-
-
-                if next_point == end_point:
-                    break
-
-                #Check for collision
-                # if self.get(next_point) == TileManager.wall:
-                #     if len(stuck_direction_reserve) == 0:
-                #         point = (point[1], point[0]) if split_dir == 'v' else point
-                #         print "Bridge generation terminated prematurely at {0}".format(point)
-                #         break
-                #     new_direction = stuck_direction_reserve.pop()
-                #     next_point = point + step_dirs[new_direction]
-                #     continue
-                #Check if we're at the halfway point vertically
-                #Check if we're lined up along the y axis
-                #Check if we're already there
-                
-                #Either we turn, or we don't. If we saw a collision, reached the first elbow,
-                #or reached the second elbow, we turn. We also need to turn if we went out of our way
-                #to avoid a mesa.
-
-
-            # TODO: Walk the map from start_point to end_point, checking mesa collision as I go,
-            # and building an elbow (multiple elbows?) at the halfway point.
+            #Join the two partitions via a bridge.
+            #BSP makes sure the graph is fully connected, as long as every join succeeds.
+            #Join the mesa on side a that's closest to the split to whichever mesa on side b
+            #is closest to it, and let the router find its way around anything in between.
+            m1 = min(mesas_a, key=lambda mesa: split_pos - (mesa.y + mesa.height if split_dir == 'h' else mesa.x + mesa.width))
+            m2 = min(mesas_b, key=lambda mesa: abs(mesa.center_x - m1.center_x) + abs(mesa.center_y - m1.center_y))
+            if not self._join_mesas(m1, m2, (x, y, width, height)):
+                #Bridges from deeper partitions can wall the route in, so look outside the
+                #partition, and failing that, try the other mesas on side b
+                whole_map = (0, 0, self.width, self.height)
+                others = sorted(mesas_b, key=lambda mesa: abs(mesa.center_x - m1.center_x) + abs(mesa.center_y - m1.center_y))
+                if not any(self._join_mesas(m1, other, whole_map) for other in others):
+                    raise RuntimeError("Couldn't bridge the partitions of {0}x{1} at {2},{3}".format(width, height, x, y))
 
             return mesas_a + mesas_b
-        #TODO: Get back the next iteration's partitions/mesas, join them together with a bridge.
+
+    def _join_mesas(self, mesa, mesa2, box):
+        """Builds a bridge, made of straight Bridge segments, between two mesas.
+        The route is found by self._router and stays inside box, an (x, y, width, height) tuple.
+        Returns whether a route was found.
+        """
+        path = self._router.route(self._get_shore(mesa), self._get_shore(mesa2), box)
+        if path is None:
+            return False
+        for segment in path_to_segments(path):
+            self._add_bridge(Bridge(*segment))
+            self.apply_patch(self._bridges[-1])
+        return True
+
+    def _get_shore(self, mesa):
+        """Returns the map coordinates of the tiles orthogonally next to a mesa, where a bridge can land"""
+        shore = []
+        for i_y in range(-1, mesa.height + 1):
+            for i_x in range(-1, mesa.width + 1):
+                if self._is_mesa_floor(mesa, i_x, i_y):
+                    continue
+                if any(self._is_mesa_floor(mesa, n_x, n_y) for n_x, n_y in get_orthog_neighbors(i_x, i_y)):
+                    shore.append((mesa.x + i_x, mesa.y + i_y))
+        return shore
+
+    def _is_mesa_floor(self, mesa, i_x, i_y):
+        return 0 <= i_x < mesa.width and 0 <= i_y < mesa.height and mesa.get(i_x, i_y) is not None
 
     def _get_bsp_partition(self, x, y, width, height, margin):
         if width <= 2*margin:
@@ -185,21 +324,14 @@ class Gamemap(object):
             #Select a random number between -1 and 1, weighted toward 0 via a beta distribution.
             #This will weight the selection in favor of partitions that make the resulting boxes more "square"
             #since a random number at 0 will select whatever the threshold decided was the short axis.
-            dir_select_num = (random.betavariate(5, 5) * 2) - 1
+            dir_select_num = (self.rng.betavariate(5, 5) * 2) - 1
             split_dir = 'v' if dir_select_num > aspect_ratio else 'h'
         #Now that we have an axis, pick a random position for the split between the ends of the box,
         #offset by the specified margin.
         min_bound = (y + margin) if split_dir == 'h' else (x + margin)
         max_bound = ((y + height) - margin) if split_dir == 'h' else ((x + width) - margin)
         #TODO: Should this also be a beta distribution? Sure, why not, yeah?
-        split_pos = random.randint(min_bound, max_bound)
-
-        #TEST: Draw test tiles along the partition edge to visualize it.
-        for tile_x in range(x, x+width):
-            for tile_y in range(y, y+height):
-                if (split_dir == 'h' and tile_y == split_pos) or (split_dir == 'v' and tile_x == split_pos):
-                        self.set(tile_x, tile_y, TileManager.test_tile)
-        #End test code
+        split_pos = self.rng.randint(min_bound, max_bound)
 
         return split_dir, split_pos
 
@@ -207,12 +339,10 @@ class Gamemap(object):
         """For each floor tile on the map, turn all orthogonal neighbors that are impass
         tiles into wall tiles.
         """
-        for i_y, row in enumerate(self._maparray):
-            for i_x, tile in enumerate(row):
-                if tile == TileManager.floor:
-                    for neighbor in get_orthog_neighbors(i_x, i_y):
-                        if neighbor[0] < self.width and neighbor[1] < self.height and self.get(neighbor[0], neighbor[1]) == TileManager.impass:
-                            self.set(neighbor[0], neighbor[1], TileManager.wall)
+        build_walls(self._maparray)
+        self.dirty_regions.mark_all()
+        for listener in self._change_listeners:
+            listener(0, 0, self.width, self.height)
 
 
     def _check_overlap(self, box1, box2):
@@ -251,71 +381,291 @@ class Gamemap(object):
         self.make_bridge(self._mesas[2], self._mesas[3], 'E')
 
     def get_map_array(self):
+        """Returns the map's TileGrid. Indexing it as maparray[y][x] gives a Tile,
+        just like a list of lists would.
+        """
         return self._maparray
 
     def make_mesa(self, x, y, r):
         """Generates a new mesa with radius r and adds it to the map with its top-left corner at x,y"""
         new_mesa = Mesa(x, y, r)
-        self._mesas.append(new_mesa)
+        self._add_mesa(new_mesa)
         self.apply_patch(new_mesa)
 
     def make_bridge(self, mesa, mesa2, dir):
-        y = None
-        x = None
-        length = None
-        if dir in ['E', 'W']:
-            max_y = min(mesa.y + mesa.height, mesa2.y + mesa2.height)
-            min_y = max(mesa.y, mesa2.y)
-            y = random.randint(min_y, max_y-1)
-        elif dir in ['N', 'S']:
-            max_x = min(mesa.x + mesa.width, mesa2.x + mesa2.width)
-            min_x = max(mesa.x, mesa2.x)
-            x = random.randint(min_x, max_x-1)
-        if x == None:
-            #Bridge is horizontal
-            x = self._get_bridge_coordinate(y, mesa.center_y, mesa.center_x, mesa.get_ribwidth, invert=(dir=='W'))
-            other_x = self._get_bridge_coordinate(y, mesa2.center_y, mesa2.center_x, mesa2.get_ribwidth, invert=(dir=='E'))
-            length = abs(x - other_x) + 1
-        if y == None:
-            #Bridge is vertical
-            y = self._get_bridge_coordinate(x, mesa.center_x, mesa.center_y, mesa.get_ribwidth, invert=(dir=='N'))
-            other_y = self._get_bridge_coordinate(x, mesa2.center_x, mesa2.center_y, mesa2.get_ribwidth, invert=(dir=='S'))
-            length = abs(y - other_y) + 1
-
-        directions = {'N': (0,-1),
-                    'E': (1,0),
-                    'S': (0,1),
-                    'W': (-1,0)}
-        new_bridge = Bridge(x, y, length, directions[dir])
-        self._bridges.append(new_bridge)
+        """Builds a bridge from mesa to mesa2, which lies in direction 'N', 'E', 'S' or 'W' from it"""
+        new_bridge = plan_bridge(self.rng, mesa, mesa2, dir)
+        self._add_bridge(new_bridge)
         self.apply_patch(new_bridge)
 
+    def label_components(self):
+        """Returns the connectivity.Components of the map's walkable tiles"""
+        return label_components(self._maparray)
+
+    def connect_mesas(self, components=None):
+        """Bridges separate walkable regions of the map together, using as little bridge as it can.
+
+        Candidate bridges run straight from each mesa to the nearest mesa east and south of it.
+        The shortest candidates that join regions not yet joined get built, so the bridges form
+        a minimum spanning tree over the regions. Regions that no straight bridge can reach are
+        then joined, smallest first, to whichever region has the mesa nearest to theirs, by a
+        bridge that bends around whatever is in the way (see router.py). A region only stays
+        separate if there's no way across the sea to it at all.
+
+        components is the map's current labeling, if it's already been done.
+        Returns the number of bridges built, counting a bent bridge as one.
+        """
+        if components is None:
+            components = self.label_components()
+        mesa_labels = [components.label_at(mesa.center_x, mesa.center_y) for mesa in self._mesas]
+        mesa_indices = dict((id(mesa), index) for index, mesa in enumerate(self._mesas))
+
+        candidates = []
+        for index, mesa in enumerate(self._mesas):
+            if mesa_labels[index] is None:
+                continue
+            for direction in ('E', 'S'):
+                other = self.find_colinear_mesa(mesa, direction)
+                if other is None:
+                    continue
+                other_index = mesa_indices[id(other)]
+                if mesa_labels[other_index] in (None, mesa_labels[index]):
+                    continue
+                if direction == 'E':
+                    gap = other.x - (mesa.x + mesa.width)
+                else:
+                    gap = other.y - (mesa.y + mesa.height)
+                #Mesas whose boxes touch can still have sea between them, but there's no room
+                #to be sure a straight bridge lands on both
+                if gap > 0:
+                    candidates.append((gap, index, direction, other_index))
+
+        #Kruskal's algorithm, over region labels
+        parents = list(range(len(components)))
+        def find(label):
+            while parents[label] != label:
+                parents[label] = parents[parents[label]]
+                label = parents[label]
+            return label
+
+        built = 0
+        for gap, index, direction, other_index in sorted(candidates):
+            root = find(mesa_labels[index])
+            other_root = find(mesa_labels[other_index])
+            if root == other_root:
+                continue
+            parents[max(root, other_root)] = min(root, other_root)
+            self.make_bridge(self._mesas[index], self._mesas[other_index], direction)
+            built += 1
+
+        #Mesas of each region still separate after that
+        regions = {}
+        for index, label in enumerate(mesa_labels):
+            if label is not None:
+                regions.setdefault(find(label), []).append(self._mesas[index])
+        if len(regions) <= 1:
+            return built
+        unlabeled = set(id(mesa) for mesa, label in zip(self._mesas, mesa_labels) if label is None)
+        self._router = BridgeRouter(self._maparray)
+        while len(regions) > 1:
+            root = min(regions, key=lambda root: len(regions[root]))
+            mesas = regions.pop(root)
+            mesa, other = self._nearest_other_mesa(mesas, unlabeled)
+            #Look near the two mesas first, then anywhere on the map
+            left, top = min(mesa.x, other.x), min(mesa.y, other.y)
+            right = max(mesa.x + mesa.width, other.x + other.width)
+            bottom = max(mesa.y + mesa.height, other.y + other.height)
+            margin = max(right - left, bottom - top)
+            near = (left - margin, top - margin, right - left + 2*margin, bottom - top + 2*margin)
+            if not (self._join_mesas(mesa, other, near) or self._join_mesas(mesa, other, (0, 0, self.width, self.height))):
+                continue
+            other_root = find(mesa_labels[mesa_indices[id(other)]])
+            parents[max(root, other_root)] = min(root, other_root)
+            joined = regions.pop(other_root)
+            joined.extend(mesas)
+            regions[min(root, other_root)] = joined
+            built += 1
+        #Let go of the router's buffers
+        self._router = None
+        return built
+
+    def _nearest_other_mesa(self, mesas, ignored=()):
+        """Returns (mesa, other), where mesa is one of mesas and other is the mesa not among them
+        whose center is nearest to mesa's, by Manhattan distance. Mesas whose ids are in ignored
+        are never picked as other.
+        """
+        own = set(id(mesa) for mesa in mesas)
+        own.update(ignored)
+        reach = 2*self.mesa_max_radius + 1
+        while True:
+            best = None
+            for mesa in mesas:
+                for other in self.get_mesas_in(mesa.center_x - reach, mesa.center_y - reach, 2*reach + 1, 2*reach + 1):
+                    if id(other) in own:
+                        continue
+                    distance = abs(other.center_x - mesa.center_x) + abs(other.center_y - mesa.center_y)
+                    if best is None or distance < best[0]:
+                        best = (distance, mesa, other)
+            #Anything nearer than reach would have been in the box, so best is the nearest
+            if best is not None and (best[0] <= reach or reach >= self.width + self.height):
+                return best[1], best[2]
+            reach *= 2
+
+    def _add_mesa(self, mesa):
+        self._mesas.append(mesa)
+        self._mesa_index.insert(mesa)
+
+    def _add_bridge(self, bridge):
+        self._bridges.append(bridge)
+        self._bridge_index.insert(bridge)
+
+    def get_mesas_in(self, x, y, width, height):
+        """Returns the mesas whose bounding boxes overlap the given box"""
+        return self._mesa_index.query_range(x, y, width, height)
+
+    def find_colinear_mesa(self, mesa, direction):
+        """Returns the nearest mesa in direction 'N', 'E', 'S' or 'W' that a straight bridge
+        from this mesa could reach, or None.
+        """
+        return self._mesa_index.nearest_colinear(mesa, direction)
+
 
     def apply_patch(self, patchsource):
         """Adds a set of tiles to the map from an object that has a patch and a set of x,y coordinates"""
-        patch = patchsource._patch
-        for i_y, row in enumerate(patch):
-            for i_x, tile in enumerate(row):
-                if i_y+patchsource.y >= self.height or i_x+patchsource.x >= self.width:
-                    raise IndexError("Patch out of bounds w{0} h{1} at {2},{3}:\n \
-                            {4}".format(self.width, self.height, i_x+patchsource.x, i_y+patchsource.y, patchsource.dbgoutput()))
-                if tile != None:
-                    self.set(i_x + patchsource.x, i_y + patchsource.y, tile)
+        if (patchsource.x < 0 or patchsource.y < 0
+                or patchsource.y + patchsource.height > self.height or patchsource.x + patchsource.width > self.width):
+            raise IndexError("Patch out of bounds w{0} h{1} at {2},{3}:\n \
+                    {4}".format(self.width, self.height, patchsource.x, patchsource.y, patchsource.dbgoutput()))
+        for tile, stencil in patchsource.get_stencils():
+            self._maparray.blit(patchsource.x, patchsource.y, stencil, tile)
+        self._mark_changed(patchsource.x, patchsource.y, patchsource.width, patchsource.height)
+
+    def iter_lines(self):
+        """Yields the map as text, one row at a time, each line ending in a newline"""
+        return self._maparray.iter_lines()
+
+    def write_to(self, fileobj):
+        """Writes the map as text to a file opened in text mode, without building it all in memory first"""
+        self._maparray.write_to(fileobj)
 
     def __str__(self):
-        mapstring = ""
-        for row in self._maparray:
-            rowstring = ""
-            for tile in row:
-                rowstring += tile.char
-            mapstring += rowstring
-            mapstring += '\n'
-        return mapstring
+        return "".join(self.iter_lines())
 
-        
+
+def plan_bridge(rng, mesa, mesa2, dir):
+    """Returns a Bridge from mesa to mesa2, which lies in direction 'N', 'E', 'S' or 'W' from it,
+    crossing at a point drawn from rng. Nothing is drawn on any map.
+    """
+    y = None
+    x = None
+    length = None
+    if dir in ['E', 'W']:
+        max_y = min(mesa.y + mesa.height, mesa2.y + mesa2.height)
+        min_y = max(mesa.y, mesa2.y)
+        y = rng.randint(min_y, max_y-1)
+    elif dir in ['N', 'S']:
+        max_x = min(mesa.x + mesa.width, mesa2.x + mesa2.width)
+        min_x = max(mesa.x, mesa2.x)
+        x = rng.randint(min_x, max_x-1)
+    if x == None:
+        #Bridge is horizontal
+        x = _get_bridge_coordinate(y, mesa.center_y, mesa.center_x, mesa.get_ribwidth, invert=(dir=='W'))
+        other_x = _get_bridge_coordinate(y, mesa2.center_y, mesa2.center_x, mesa2.get_ribwidth, invert=(dir=='E'))
+        length = abs(x - other_x) + 1
+    if y == None:
+        #Bridge is vertical
+        y = _get_bridge_coordinate(x, mesa.center_x, mesa.center_y, mesa.get_ribwidth, invert=(dir=='N'))
+        other_y = _get_bridge_coordinate(x, mesa2.center_x, mesa2.center_y, mesa2.get_ribwidth, invert=(dir=='S'))
+        length = abs(y - other_y) + 1
+
+    directions = {'N': (0,-1),
+                'E': (1,0),
+                'S': (0,1),
+                'W': (-1,0)}
+    return Bridge(x, y, length, directions[dir])
+
+def _get_bridge_coordinate(par_coord, center_par, center_perp, get_ribwidth, invert=False):
+    """Returns where a bridge meets a mesa: the coordinate, across the bridge, of the first tile
+    past the mesa's edge, on a line through it at par_coord.
+    center_par and center_perp are the mesa's center along and across the bridge.
+    invert is True for the edge on the negative side.
+    """
+    edge_distance = get_ribwidth(par_coord - center_par) + 1
+    return center_perp - edge_distance if invert else center_perp + edge_distance
 
 def get_orthog_neighbors(x, y):
     """For the given x,y coordinates, returns a list of tuples
     containing adjacent coordinates to the left, right, up and down
     """
     return [(x+1, y), (x-1, y), (x, y+1), (x, y-1)]
+
+def build_walls(grid, wrap_edges=True, above_floor=0, below_floor=None):
+    """Turns every impass tile in the TileGrid that is orthogonally next to a floor tile into a wall.
+
+    Works a row at a time on byte masks (see TileGrid.row_mask) rather than tile by tile.
+    If wrap_edges is set, a floor tile in column or row 0 also walls in its x-1 or y-1
+    neighbor on the far edge of the grid, like the old get_orthog_neighbors loop did
+    through negative list indices.
+
+    To wall a band of a larger map, pass the floor masks of the rows just above and below
+    the band as above_floor and below_floor. By default there's no floor above the grid, and
+    below it there's none, or with wrap_edges, the grid's own top row.
+    """
+    width, height = grid.width, grid.height
+    row_bits = 8 * width
+    full_row = (1 << row_bits) - 1
+    wrap_shift = row_bits - 8
+
+    floor = grid.row_mask(0, [TileManager.floor])
+    if below_floor is None:
+        #y=0 -> y=height-1 wraparound
+        below_floor = floor if wrap_edges else 0
+    last_below_floor = below_floor
+    for y in range(height):
+        below_floor = grid.row_mask(y+1, [TileManager.floor]) if y+1 < height else last_below_floor
+
+        #Left and right neighbors
+        neighbors = ((floor << 8) & full_row) | (floor >> 8)
+        neighbors |= above_floor | below_floor
+        if wrap_edges:
+            #x=0 -> x=width-1 wraparound
+            neighbors |= (floor >> wrap_shift) & 1
+        walls = neighbors & grid.row_mask(y, [TileManager.impass])
+        if walls:
+            grid.set_row_mask(y, walls, TileManager.wall)
+        above_floor, floor = floor, below_floor
+
+def _place_band_mesas(width, height, seed, band, max_radius, density):
+    """Returns (x, y, r) for each mesa whose top edge lies in the given band.
+
+    Mesas can hang over into the band below, but never off the map.
+    """
+    rng = random.Random("{0}/{1}".format(seed, band))
+    top = band * GENERATION_BAND_HEIGHT
+    bottom = min(top + GENERATION_BAND_HEIGHT, height)
+    band_area = width * (bottom - top)
+    mesas = []
+    total_mesa_area = 0
+    while (total_mesa_area/band_area) < density:
+        r = rng.randint(0, max_radius)
+        y = rng.randint(top, bottom-1)
+        x = rng.randint(0, width-(2*r + 1))
+        total_mesa_area += r**2
+        if y + 2*r + 1 <= height:
+            mesas.append((x, y, r))
+    return mesas
+
+def _rasterize_band(args):
+    """Process pool worker for Gamemap._create_map_parallel.
+
+    Returns the band's own mesas, and the band's tile codes as bytes with the mesas of
+    this band and the band above drawn in.
+    """
+    width, height, seed, band, max_radius, density = args
+    top = band * GENERATION_BAND_HEIGHT
+    band_grid = TileGrid(width, min(GENERATION_BAND_HEIGHT, height - top), TileManager.impass)
+    mesas = _place_band_mesas(width, height, seed, band, max_radius, density)
+    overhanging = _place_band_mesas(width, height, seed, band-1, max_radius, density) if band > 0 else []
+    for x, y, r in overhanging + mesas:
+        band_grid.blit_clipped(x, y - top, get_mesa_stencil(r), TileManager.floor)
+    return mesas, band_grid.read_rows(0, band_grid.height)
@@ -0,0 +1,279 @@
+"""Stand-ins for curses, so the interface can run without a terminal
+
+FakeWindow implements the part of the curses window interface the game uses, drawing into a
+grid of characters in memory and reading keys from a list rather than the keyboard.
+patch_curses() stands in for the module-level curses functions that need a terminal.
+Together they let replay_session() play a stream of keys through the real game loop, key
+handling and panels, to test or time the interface end to end.
+"""
+import asyncio
+import collections
+import contextlib
+import curses
+import time
+
+import events
+import keyinput
+
+class FakeWindow(object):
+    """A curses window that draws into memory.
+
+    As in curses, subwindows share their parent's characters, and keys can be read from any
+    window. Drawing outside the window raises curses.error, and so does drawing in its
+    bottom-right corner, since curses can't move the cursor past it.
+    """
+
+    def __init__(self, height, width, keys=()):
+        self.height = height
+        self.width = width
+        #Where the window is on the screen
+        self.top = 0
+        self.left = 0
+        #Rows of characters, for the whole screen
+        self._cells = [[' '] * width for i in range(height)]
+        self._keys = collections.deque(keys)
+        self._scrollok = False
+        self.cursor = (0, 0)
+        self.refresh_count = 0
+
+    def subwin(self, *args):
+        """subwin(nlines, ncols, begin_y, begin_x), or subwin(begin_y, begin_x) to reach the
+        bottom-right corner. begin_y and begin_x are screen coordinates.
+        """
+        if len(args) == 2:
+            begin_y, begin_x = args
+            nlines = self.top + self.height - begin_y
+            ncols = self.left + self.width - begin_x
+        else:
+            nlines, ncols, begin_y, begin_x = args
+        if (nlines <= 0 or ncols <= 0 or begin_y < self.top or begin_x < self.left
+                or begin_y + nlines > self.top + self.height or begin_x + ncols > self.left + self.width):
+            raise curses.error("subwin() returned ERR")
+        window = FakeWindow.__new__(FakeWindow)
+        window.height = nlines
+        window.width = ncols
+        window.top = begin_y
+        window.left = begin_x
+        window._cells = self._cells
+        window._keys = self._keys
+        window._scrollok = False
+        window.cursor = (0, 0)
+        window.refresh_count = 0
+        return window
+
+    def getmaxyx(self):
+        return (self.height, self.width)
+
+    def getbegyx(self):
+        return (self.top, self.left)
+
+    def addstr(self, y, x, text, attr=0):
+        self._check(y, x)
+        for line_number, line in enumerate(str(text).split('\n')):
+            if line_number > 0:
+                #A newline clears the rest of the row and moves down
+                self.cursor = (y, x)
+                self.clrtoeol()
+                y, x = y + 1, 0
+                if y >= self.height:
+                    raise curses.error("addstr() returned ERR")
+            while True:
+                room = self.width - x
+                row = self._cells[self.top + y]
+                row[self.left + x:self.left + x + min(room, len(line))] = line[:room]
+                if len(line) <= room:
+                    x += len(line)
+                    break
+                #Wrap onto the next row
+                line = line[room:]
+                y, x = y + 1, 0
+                if y >= self.height:
+                    raise curses.error("addstr() returned ERR")
+        if x >= self.width:
+            if y == self.height - 1:
+                raise curses.error("addstr() returned ERR")
+            y, x = y + 1, 0
+        self.cursor = (y, x)
+
+    def addch(self, y, x, char, attr=0):
+        self.addstr(y, x, chr(char) if isinstance(char, int) else char, attr)
+
+    def insch(self, y, x, char, attr=0):
+        """Inserts a character, pushing the rest of the row right and off the edge"""
+        self._check(y, x)
+        row = self._cells[self.top + y]
+        start, end = self.left + x, self.left + self.width
+        row[start:end] = [chr(char) if isinstance(char, int) else char] + row[start:end - 1]
+
+    def delch(self, y, x):
+        """Deletes a character, pulling the rest of the row left"""
+        self._check(y, x)
+        row = self._cells[self.top + y]
+        start, end = self.left + x, self.left + self.width
+        row[start:end] = row[start + 1:end] + [' ']
+
+    def move(self, y, x):
+        self._check(y, x)
+        self.cursor = (y, x)
+
+    def clrtoeol(self):
+        y, x = self.cursor
+        row = self._cells[self.top + y]
+        row[self.left + x:self.left + self.width] = [' '] * (self.width - x)
+
+    def scrollok(self, flag):
+        self._scrollok = flag
+
+    def scroll(self, lines=1):
+        """Moves the window's contents up lines rows, or down if lines is negative"""
+        if not self._scrollok:
+            raise curses.error("scroll() returned ERR")
+        rows = [self._cells[self.top + y][self.left:self.left + self.width] for y in range(self.height)]
+        blank = [[' '] * self.width for i in range(min(abs(lines), self.height))]
+        rows = (rows[lines:] + blank) if lines > 0 else (blank + rows[:self.height + lines])
+        for y, row in enumerate(rows[:self.height]):
+            self._cells[self.top + y][self.left:self.left + self.width] = row
+
+    def border(self, *args):
+        """Draws a plain ASCII border around the edge of the window"""
+        top_row = '+' + '-' * (self.width - 2) + '+'
+        for y in (0, self.height - 1):
+            self._cells[self.top + y][self.left:self.left + self.width] = top_row
+        for y in range(1, self.height - 1):
+            row = self._cells[self.top + y]
+            row[self.left] = row[self.left + self.width - 1] = '|'
+
+    def clear(self):
+        for y in range(self.height):
+            self._cells[self.top + y][self.left:self.left + self.width] = [' '] * self.width
+        self.cursor = (0, 0)
+
+    erase = clear
+
+    def refresh(self):
+        self.refresh_count += 1
+
+    noutrefresh = refresh
+
+    def nodelay(self, flag):
+        pass
+
+    def keypad(self, flag):
+        pass
+
+    def getkey(self):
+        """Returns the next key fed to the window. With none left, raises curses.error,
+        as a window in nodelay mode does when no key has been pressed.
+        """
+        if not self._keys:
+            raise curses.error("no input")
+        return self._keys.popleft()
+
+    def feed_keys(self, keys):
+        self._keys.extend(keys)
+
+    def keys_left(self):
+        return len(self._keys)
+
+    def row_text(self, y):
+        return "".join(self._cells[self.top + y][self.left:self.left + self.width])
+
+    def text(self):
+        """Returns what's in the window, as lines of text"""
+        return "\n".join(self.row_text(y) for y in range(self.height))
+
+    def _check(self, y, x):
+        if not (0 <= y < self.height and 0 <= x < self.width):
+            raise curses.error("{0}, {1} is outside a {2}x{3} window".format(x, y, self.width, self.height))
+
+
+#Color pairs set by init_pair while curses is patched: pair number -> (foreground, background)
+color_pairs = {}
+
+def init_pair(pair_number, foreground, background):
+    color_pairs[pair_number] = (foreground, background)
+
+def color_pair(pair_number):
+    #The same attribute bits curses uses
+    return pair_number << 8
+
+@contextlib.contextmanager
+def patch_curses(width, height):
+    """Stands in for the module-level curses functions and values that need a terminal,
+    for a width x height screen, until the with block ends
+    """
+    replacements = {
+        "init_pair": init_pair,
+        "color_pair": color_pair,
+        "curs_set": lambda visibility: 1,
+        "COLS": width,
+        "LINES": height,
+    }
+    missing = object()
+    saved = dict((name, getattr(curses, name, missing)) for name in replacements)
+    for name, value in replacements.items():
+        setattr(curses, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is missing:
+                delattr(curses, name)
+            else:
+                setattr(curses, name, value)
+
+def replay_session(keys, width=120, height=40, gamemap=None, seed=0):
+    """Plays keys through a headless game as fast as it will go: every key goes through the
+    game loop, keyinput.handle_key or a waiting panel, and a redraw.
+
+    If gamemap isn't given, one is generated with seed to fill the screen. A player is put on
+    the first floor tile. Note that the panels keep listening to events afterwards, so each
+    session is best run in its own process.
+
+    Returns a dict with the number of keys played, the seconds taken, keys per second, and
+    the frames drawn and world ticks run.
+    """
+    #Imported here, so that the stand-ins are importable by anything main imports
+    import main
+    from entities import Player
+    from gamemap import Gamemap
+    from tilemanager import TileManager
+
+    with patch_curses(width, height):
+        screen = FakeWindow(height, width, keys)
+        key_input = keyinput.KeyInput(screen, poll_interval=0)
+        if gamemap is None:
+            gamemap = Gamemap(width, height - 1, seed=seed)
+        game_loop, gameworld, panellist = main.create_game(screen, key_input, gamemap=gamemap, frame_rate=None)
+
+        grid = gamemap.get_map_array()
+        start = grid.raw_codes().find(TileManager.floor.code)
+        player = Player(max(start, 0) % grid.width, max(start, 0) // grid.width, gameworld.get_cell)
+        #Added by event, as the game does, so that everything listening sees the player arrive
+        events.trigger_event("world_add_entity", player)
+
+        async def stop_when_done():
+            while screen.keys_left() or key_input.pending():
+                await asyncio.sleep(0)
+            #Wait for the last key's frame
+            while game_loop.redraw_pending:
+                await asyncio.sleep(0)
+            game_loop.stop()
+
+        async def run():
+            game_loop.spawn(stop_when_done())
+            await main.play(game_loop, panellist)
+
+        key_count = len(screen._keys)
+        start_time = time.perf_counter()
+        asyncio.run(run())
+        elapsed = time.perf_counter() - start_time
+        player.stop_listening()
+
+    return {
+        "keys": key_count,
+        "seconds": elapsed,
+        "turns_per_second": key_count / elapsed if elapsed > 0 else float('inf'),
+        "frames": game_loop.frame_count,
+        "ticks": game_loop.tick_count,
+    }
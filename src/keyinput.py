@@ -1,6 +1,108 @@
 """A module for handling keyboard input"""
+import asyncio
+import collections
+import curses
+import json
+import time
+
 import events
 
+#Seconds between checks for new keypresses
+INPUT_POLL_INTERVAL = 1/100
+
+class KeyInput(object):
+    """Reads keys from a curses window without blocking, and hands them out to the coroutines
+    waiting for them.
+
+    Modal waiters, such as a panel waiting for a message to be dismissed, get keys before
+    anything else that's waiting. Keys pressed while nothing is waiting are kept until
+    something asks.
+    """
+
+    def __init__(self, window, poll_interval=INPUT_POLL_INTERVAL):
+        self.window = window
+        self.window.nodelay(True)
+        #Seconds between polls. 0 just yields to the rest of the game between them.
+        self.poll_interval = poll_interval
+        self._buffer = collections.deque()
+        #Futures waiting for a key, in the order they asked
+        self._modal_waiters = collections.deque()
+        self._waiters = collections.deque()
+
+    def poll(self):
+        """Reads every key pressed since the last poll. Returns how many there were."""
+        count = 0
+        while True:
+            try:
+                key = self.window.getkey()
+            except curses.error:
+                #No input waiting
+                return count
+            self.feed(key)
+            count += 1
+
+    def feed(self, key):
+        """Hands a key to the first waiter, or keeps it if nothing's waiting"""
+        for waiters in (self._modal_waiters, self._waiters):
+            while waiters:
+                waiter = waiters.popleft()
+                #Waiters whose coroutine was cancelled are already done
+                if not waiter.done():
+                    waiter.set_result(key)
+                    return
+        self._buffer.append(key)
+
+    async def get_key(self, modal=False):
+        """Waits for the next keypress and returns it"""
+        if self._buffer:
+            return self._buffer.popleft()
+        waiter = asyncio.get_running_loop().create_future()
+        (self._modal_waiters if modal else self._waiters).append(waiter)
+        return await waiter
+
+    def pending(self):
+        """Returns how many keys have been read but not yet handed out"""
+        return len(self._buffer)
+
+    async def run(self):
+        """Polls for keys until cancelled"""
+        while True:
+            self.poll()
+            await asyncio.sleep(self.poll_interval)
+
+
+class KeyRecorder(object):
+    """Wraps a curses window, noting down every key read from it with getkey, and when.
+    Everything else is passed straight through to the window.
+    """
+
+    def __init__(self, window):
+        self._window = window
+        self._start = time.perf_counter()
+        self.keys = []
+        #Seconds from the start of recording to each key
+        self.times = []
+
+    def __getattr__(self, name):
+        return getattr(self._window, name)
+
+    def getkey(self, *args):
+        key = self._window.getkey(*args)
+        self.keys.append(key)
+        self.times.append(time.perf_counter() - self._start)
+        return key
+
+    def save(self, filename):
+        with open(filename, 'w') as out_file:
+            json.dump({"keys": self.keys, "times": self.times}, out_file)
+
+def load_recording(filename):
+    """Returns the list of keys in a file saved by KeyRecorder.save"""
+    with open(filename) as in_file:
+        return json.load(in_file)["keys"]
+
+
+
 def handle_key(key):
     if key in ["y", "7"]:
         events.trigger_event("player_move", x_dir=-1, y_dir=-1)
@@ -24,3 +126,9 @@ def handle_key(key):
         events.trigger_event("player_drop_inventory")
     if key in ['>', '<']:
         events.trigger_event("player_use_portal")
+    if key in ['P']:
+        events.trigger_event("profiler_toggle_overlay")
+    if key in ['C']:
+        events.trigger_event("profiler_toggle_cprofile")
+    if key in ['J']:
+        events.trigger_event("profiler_export")
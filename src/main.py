@@ -1,16 +1,52 @@
 #!/usr/bin/env python3
 
-import sys
+import argparse
+import asyncio
 import curses
 
 import dbgoutput
 import keyinput
 import events
+import profiling
+from entities import Player
+from fov import FieldOfView
 from gamemap import Gamemap
+from gameloop import GameLoop
+from world import GameWorld
 from tilemanager import TileManager
 from screenpanels import MessagePanel, ListMenu, GamePanel
 
-def main(stdscr):
+#How far the player can see, in tiles
+SIGHT_RADIUS = 12
+
+def main(stdscr, record_to=None):
+    """Runs the game in a curses window. If record_to is given, every key pressed is saved
+    to that file on the way out, for keyinput.load_recording to play back.
+    """
+    key_window = stdscr if record_to is None else keyinput.KeyRecorder(stdscr)
+    game_loop, gameworld, panellist = create_game(stdscr, keyinput.KeyInput(key_window))
+
+    #Game Loop
+    try:
+        asyncio.run(play(game_loop, panellist))
+    except KeyboardInterrupt:
+        #Ctrl-C
+        pass
+    except SystemExit:
+        pass
+    finally:
+        if record_to is not None:
+            key_window.save(record_to)
+
+    #Close curses and put the terminal back in normal mode.
+    stdscr.refresh()
+
+def create_game(stdscr, key_input, gamemap=None, **loop_args):
+    """Sets up a game in stdscr, reading keys from key_input. If gamemap isn't given, a new
+    map is created to fill the screen. loop_args are passed on to the GameLoop.
+
+    Returns a tuple of the GameLoop, the GameWorld, and the panels other than the game panel.
+    """
     #Initialize curses
     curses.curs_set(False) #Turn off the cursor
     #Initialize debug output printer
@@ -20,42 +56,88 @@ def main(stdscr):
     #Clear the terminal
     stdscr.clear()
 
-    #Create a new map to fill the screen.
-    gamemap = Gamemap(curses.COLS, curses.LINES-1)
+    if gamemap is None:
+        #Create a new map to fill the screen.
+        gamemap = Gamemap(curses.COLS, curses.LINES-1)
+    #Entities and features on the map, indexed by cell
+    gameworld = GameWorld(gamemap)
+    #Cells entities leave or vanish from need to be redrawn
+    def mark_entity_move(entity, old_x, old_y):
+        gamemap.dirty_regions.mark(old_x, old_y)
+        gamemap.dirty_regions.mark(entity.x, entity.y)
+    events.listen_to_event("entity_moved", mark_entity_move)
+    events.listen_to_event("on_entity_death", lambda entity: gamemap.dirty_regions.mark(entity.x, entity.y))
+    #The player sees from wherever they're put and every cell they step to
+    field_of_view = FieldOfView(gamemap)
+    def look_around(entity, *old_coords):
+        if isinstance(entity, Player):
+            field_of_view.compute(entity.x, entity.y, SIGHT_RADIUS)
+    events.listen_to_event("world_add_entity", look_around)
+    events.listen_to_event("entity_moved", look_around)
 
     gamepanel, panellist = create_panel_layout(stdscr)
 
     #Output debugging messages in the upper-left corner
     dbgoutput.print_output()
 
-    #Game Loop
-    while True:
-        try:
-            draw_screen(stdscr, gamemap, gamepanel, panellist, show_debug_text=True)
-            keyinput.handle_key(stdscr.getkey())
-            # gameworld.update_world()
-        except KeyboardInterrupt:
-            #Ctrl-C
-            stdscr.refresh()
-            sys.exit()
-        except SystemExit:
-            stdscr.refresh()
-            sys.exit()
-
-    #Close curses and put the terminal back in normal mode.
-    stdscr.refresh()
-    stdscr.getkey()
+    #Frame timings, shown over the top of everything while they're on
+    profiler = profiling.get_profiler()
+    def toggle_profiler_overlay():
+        if not profiler.toggle():
+            #Wipe the overlay off
+            stdscr.clear()
+            gamemap.dirty_regions.mark_all()
+            for panel in panellist:
+                panel.mark_changed()
+    def toggle_cprofile():
+        filename = profiler.toggle_cprofile()
+        if filename is not None:
+            events.trigger_event("print_message", "Profile saved to {0}".format(filename))
+    def export_timings():
+        filename = profiler.export_json(include_samples=True)
+        events.trigger_event("print_message", "Timings saved to {0}".format(filename))
+    events.listen_to_event("profiler_toggle_overlay", toggle_profiler_overlay)
+    events.listen_to_event("profiler_toggle_cprofile", toggle_cprofile)
+    events.listen_to_event("profiler_export", export_timings)
+
+    def tick(tick_count):
+        gameworld.update_world(tick_count)
+        #The overlay's numbers change all the time
+        return gamemap.dirty_regions.has_changes() or profiler.enabled
+
+    game_loop = GameLoop(key_input,
+                         lambda: draw_screen(stdscr, gamemap, gamepanel, panellist, field_of_view, show_debug_text=True),
+                         tick, **loop_args)
+    return (game_loop, gameworld, panellist)
+
+async def play(game_loop, panellist):
+    """Runs the game loop, and the panels alongside it"""
+    #The panels wait on their own for things to show and keys to dismiss them
+    for panel in panellist:
+        game_loop.spawn(panel.run(game_loop))
+    await game_loop.run()
 
-def draw_screen(stdscr, gamemap, gamepanel, panellist, show_debug_text=False):
+def draw_screen(stdscr, gamemap, gamepanel, panellist, field_of_view=None, show_debug_text=False):
     #Update panels
     for panel in panellist:
-        panel.display()
+        with profiling.phase("display", type(panel).__name__):
+            panel.display()
+
+    with profiling.phase("display", "GamePanel"):
+        #Until there's a player to see from, the whole map is shown
+        visibility = field_of_view if field_of_view is not None and field_of_view.visible is not None else None
+        gamepanel.display(gamemap.get_map_array(), dirty_rects=gamemap.dirty_regions.take(), visibility=visibility)
 
-    gamepanel.display(gamemap.get_map_array())
+    profiler = profiling.get_profiler()
+    if profiler.enabled:
+        for line in profiler.overlay_lines(limit=curses.LINES - 2):
+            dbgoutput.add_string(line[:curses.COLS - 2])
 
-    if show_debug_text:
+    if show_debug_text or profiler.enabled:
         dbgoutput.print_output()
 
+    stdscr.refresh()
+
 def create_panel_layout(stdscr):
     """Returns a tuple:
     First, the game window.
@@ -78,7 +160,10 @@ def create_panel_layout(stdscr):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Explore the dolmen coast")
+    parser.add_argument('--record', metavar='FILE', help="Save every key pressed to FILE, to replay later")
+    args = parser.parse_args()
     #Wrap our program in a curses scope.
-    curses.wrapper(main)
+    curses.wrapper(main, record_to=args.record)
     #This will clean up the terminal state if the program throws an exception,
     #or just after it finishes running.
@@ -0,0 +1,148 @@
+"""Saving and loading maps in a compact binary format
+
+A map file is laid out as:
+    header      magic, format version, width, height, seed, record counts and the grid's offset
+    palette     the character of each tile code, in code order
+    mesas       one (x, y, r) record per mesa
+    bridges     one (x, y, length, x_dir, y_dir) record per bridge
+    padding     up to the next GRID_ALIGNMENT bytes
+    grid        width*height tile codes, one byte each, row by row
+
+All numbers are little-endian. The grid is aligned so that it can be memory-mapped directly:
+load_map doesn't read it, it maps it, and the OS only pages in the parts that get touched.
+"""
+import mmap
+import os
+import struct
+
+from gamemap import Gamemap
+from patches import Mesa, Bridge
+from tilegrid import TileGrid
+from tilemanager import Tile, TileManager
+
+MAGIC = b"DOLMAP"
+FORMAT_VERSION = 1
+#mmap offsets must be a multiple of the allocation granularity, which is 64KB on Windows
+GRID_ALIGNMENT = 65536
+
+#magic, version, width, height, has_seed, seed, palette size, mesa count, bridge count, grid offset
+_HEADER = struct.Struct("<6sHIIBqHIIQ")
+_MESA = struct.Struct("<iii")
+_BRIDGE = struct.Struct("<iiibb")
+
+class MapFormatError(ValueError):
+    """Raised when a file isn't a map file this version can read"""
+    pass
+
+def save_map(gamemap, path):
+    """Writes a Gamemap to path in the binary map format.
+
+    Raises ValueError if the map's seed is anything but None or an int that fits in 64 bits,
+    since the file couldn't give the same seed back.
+    """
+    grid = gamemap.get_map_array()
+    seed = gamemap.seed
+    if seed is not None and not (isinstance(seed, int) and -2**63 <= seed < 2**63):
+        raise ValueError("Can't save seed {0!r}: map files only hold seeds that are ints from -2**63 up to 2**63".format(seed))
+    has_seed = seed is not None
+
+    palette = b"".join(_pack_char(tile.char) for tile in grid.palette)
+    mesas = b"".join(_MESA.pack(mesa.x, mesa.y, mesa.r) for mesa in gamemap._mesas)
+    bridges = b"".join(_pack_bridge(bridge) for bridge in gamemap._bridges)
+
+    records_end = _HEADER.size + len(palette) + len(mesas) + len(bridges)
+    grid_offset = -(-records_end // GRID_ALIGNMENT) * GRID_ALIGNMENT
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, gamemap.width, gamemap.height,
+                            has_seed, seed if has_seed else 0,
+                            len(grid.palette), len(gamemap._mesas), len(gamemap._bridges), grid_offset)
+
+    with open(path, 'wb') as mapfile:
+        mapfile.write(header)
+        mapfile.write(palette)
+        mapfile.write(mesas)
+        mapfile.write(bridges)
+        mapfile.write(b"\0" * (grid_offset - records_end))
+        for y in range(gamemap.height):
+            mapfile.write(grid.row_codes(y))
+
+def load_map(path):
+    """Returns the Gamemap saved at path.
+
+    The tile grid is a copy-on-write memory map of the file, so the map can be changed
+    in memory without touching the file.
+    """
+    with open(path, 'rb') as mapfile:
+        header = mapfile.read(_HEADER.size)
+        if len(header) < _HEADER.size or header[:len(MAGIC)] != MAGIC:
+            raise MapFormatError("{0} is not a map file".format(path))
+        (_, version, width, height, has_seed, seed,
+            palette_size, mesa_count, bridge_count, grid_offset) = _HEADER.unpack(header)
+        if version != FORMAT_VERSION:
+            raise MapFormatError("{0} is map format version {1}, expected {2}".format(path, version, FORMAT_VERSION))
+
+        #Check the file holds everything the header says it does before reading any of it
+        file_size = os.fstat(mapfile.fileno()).st_size
+        if grid_offset % mmap.ALLOCATIONGRANULARITY != 0:
+            raise MapFormatError("{0} has its grid at offset {1}, which can't be memory-mapped".format(path, grid_offset))
+        if grid_offset + width * height > file_size:
+            raise MapFormatError("{0} is truncated: its {1}x{2} grid needs {3} bytes but the file is {4}".format(
+                path, width, height, grid_offset + width * height, file_size))
+
+        chars = [_read_char(mapfile, path) for i in range(palette_size)]
+        mesas = [Mesa(*fields) for fields in _MESA.iter_unpack(_read_exactly(mapfile, _MESA.size * mesa_count, path))]
+        bridges = [_unpack_bridge(*fields) for fields in _BRIDGE.iter_unpack(_read_exactly(mapfile, _BRIDGE.size * bridge_count, path))]
+        if mapfile.tell() > grid_offset:
+            raise MapFormatError("{0} has more records than fit before its grid".format(path))
+
+        codes = mmap.mmap(mapfile.fileno(), width * height, access=mmap.ACCESS_COPY, offset=grid_offset) if width * height > 0 else bytearray()
+
+    palette = TileManager.palette
+    if chars != [tile.char for tile in palette[:len(chars)]]:
+        #The file's codes mean something different from ours, so they have to be translated
+        codes, palette = _remap_codes(codes, chars)
+    grid = TileGrid(width, height, palette=palette, codes=codes)
+    return Gamemap.from_grid(grid, mesas, bridges, seed if has_seed else None)
+
+def _pack_char(char):
+    encoded = char.encode('utf-8')
+    return struct.pack("<B", len(encoded)) + encoded
+
+def _read_exactly(mapfile, size, path):
+    """Reads size bytes, raising MapFormatError if the file ends first"""
+    data = mapfile.read(size)
+    if len(data) < size:
+        raise MapFormatError("{0} ends in the middle of its records".format(path))
+    return data
+
+def _read_char(mapfile, path):
+    length, = struct.unpack("<B", _read_exactly(mapfile, 1, path))
+    return _read_exactly(mapfile, length, path).decode('utf-8')
+
+def _pack_bridge(bridge):
+    return _BRIDGE.pack(bridge.x, bridge.y, bridge.length, bridge.direction[0], bridge.direction[1])
+
+def _unpack_bridge(x, y, length, x_dir, y_dir):
+    """Rebuilds a Bridge from its stored top-left corner.
+
+    Bridge moves its origin to its top-left corner when pointed north or west, so undo that first.
+    """
+    origin_x = x + length - 1 if x_dir < 0 else x
+    origin_y = y + length - 1 if y_dir < 0 else y
+    return Bridge(origin_x, origin_y, length, (x_dir, y_dir))
+
+def _remap_codes(codes, chars):
+    """Translates a file's tile codes to TileManager.palette codes, matching tiles by character.
+    Characters TileManager doesn't know about get new tiles appended to a copy of the palette.
+
+    Returns the translated codes and the palette they index into.
+    """
+    palette = list(TileManager.palette)
+    by_char = dict((tile.char, code) for code, tile in enumerate(palette))
+    table = bytearray(range(256))
+    for file_code, char in enumerate(chars):
+        if char not in by_char:
+            new_tile = Tile(char)
+            new_tile.code = by_char[char] = len(palette)
+            palette.append(new_tile)
+        table[file_code] = by_char[char]
+    return bytearray(codes[:].translate(bytes(table))), palette
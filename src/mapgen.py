@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Generates maps in bulk without a terminal
+
+Nothing here touches curses, so it can run on a server with no TTY to pre-bake maps.
+
+Example: python3 mapgen.py --count 100 --width 1024 --height 1024 --seed 0 --format binary out/
+writes out/map_0.bin through out/map_99.bin, one map per seed.
+
+Maps too big for memory can be streamed to disk a band at a time, optionally gzipped:
+python3 mapgen.py --stream --compress --width 100000 --height 100000 out/
+"""
+import argparse
+import gzip
+import os
+import sys
+import time
+
+from gamemap import Gamemap
+from mapfile import save_map
+from streammap import StreamedMap
+
+MAP_FORMATS = {"text": ".txt", "binary": ".bin"}
+
+class ConnectedGamemap(Gamemap):
+    """A Gamemap with its randomly placed mesas bridged together"""
+    connect_islands = True
+
+class ConnectedStreamedMap(StreamedMap):
+    """A StreamedMap with its mesas bridged together"""
+    connect_islands = True
+
+def generate_maps(width, height, seeds, workers=None, layout="default", connect_islands=False):
+    """Generates one map per seed. With connect_islands, the default layout's mesas are
+    bridged together (see Gamemap.connect_mesas).
+
+    Yields (seed, gamemap, seconds) tuples, where seconds is how long that map took to generate.
+    """
+    map_class = ConnectedGamemap if connect_islands else Gamemap
+    for seed in seeds:
+        start = time.perf_counter()
+        gamemap = map_class(width, height, seed=seed, workers=workers, layout=layout)
+        yield seed, gamemap, time.perf_counter() - start
+
+def write_map(gamemap, path, map_format="text"):
+    """Writes a map to path, either as text (see Gamemap.write_to) or in the binary
+    map format that mapfile.load_map reads.
+    """
+    if map_format == "text":
+        with open(path, 'w') as mapfile:
+            gamemap.write_to(mapfile)
+    elif map_format == "binary":
+        save_map(gamemap, path)
+    else:
+        raise ValueError("Unknown map format {0}, expected one of {1}".format(map_format, sorted(MAP_FORMATS)))
+
+def write_streamed_map(width, height, seed, path, compress=False, connect_islands=False):
+    """Generates a map a band at a time straight into path as text, never holding all of it
+    in memory (see streammap.StreamedMap). With compress, the text is gzipped on the way.
+    With connect_islands, the mesas are bridged together.
+    """
+    opener = gzip.open if compress else open
+    map_class = ConnectedStreamedMap if connect_islands else StreamedMap
+    with opener(path, 'wt') as mapfile:
+        map_class(width, height, seed=seed).write_to(mapfile)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate maps without a terminal")
+    parser.add_argument("outdir", help="Directory to write maps to")
+    parser.add_argument("--count", type=int, default=1, help="Number of maps to generate")
+    parser.add_argument("--width", type=int, default=80)
+    parser.add_argument("--height", type=int, default=24)
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first map. Each following map uses the next seed.")
+    parser.add_argument("--format", choices=sorted(MAP_FORMATS), default="text", dest="map_format")
+    parser.add_argument("--workers", type=int, default=None, help="Generate each map across this many processes")
+    parser.add_argument("--layout", choices=["default", "poisson", "bsp"], default="default")
+    parser.add_argument("--check-connectivity", action="store_true", help="Report how many separate walkable regions each map has")
+    parser.add_argument("--connect-islands", action="store_true",
+                        help="Bridge the default layout's mesas together. The poisson and bsp layouts always are.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Write each map to disk a band at a time as it's generated, for maps too big for memory. Text format only.")
+    parser.add_argument("--compress", action="store_true", help="With --stream, gzip each map as it's written")
+    args = parser.parse_args(argv)
+    if args.stream and (args.map_format != "text" or args.workers is not None or args.layout != "default" or args.check_connectivity):
+        parser.error("--stream only makes default layout text maps, and can't check connectivity")
+    if args.workers is not None and args.layout != "default":
+        parser.error("--workers only works with the default layout")
+    if args.compress and not args.stream:
+        parser.error("--compress needs --stream")
+
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    seeds = range(args.seed, args.seed + args.count)
+    total_time = 0
+    if args.stream:
+        for seed in seeds:
+            path = os.path.join(args.outdir, "map_{0}{1}".format(seed, MAP_FORMATS["text"] + (".gz" if args.compress else "")))
+            start = time.perf_counter()
+            write_streamed_map(args.width, args.height, seed, path, args.compress, args.connect_islands)
+            seconds = time.perf_counter() - start
+            total_time += seconds
+            print("seed {0}: {1:.3f}s -> {2}".format(seed, seconds, path))
+    else:
+        for seed, gamemap, seconds in generate_maps(args.width, args.height, seeds, args.workers, args.layout, args.connect_islands):
+            path = os.path.join(args.outdir, "map_{0}{1}".format(seed, MAP_FORMATS[args.map_format]))
+            write_map(gamemap, path, args.map_format)
+            total_time += seconds
+            report = "seed {0}: {1:.3f}s -> {2}".format(seed, seconds, path)
+            if args.check_connectivity:
+                report += " ({0} regions)".format(gamemap.label_components().count)
+            print(report)
+
+    if args.count > 0 and total_time > 0:
+        print("{0} maps in {1:.3f}s of generation, {2:.2f} maps/s".format(args.count, total_time, args.count / total_time))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
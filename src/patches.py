@@ -1,11 +1,68 @@
 from __future__ import division
 
+import collections
+import functools
 import math
 
 from tilemanager import TileManager
 
+#How many distinct mesa radii to keep rasterized stencils for
+STENCIL_CACHE_SIZE = 64
+
+class Stencil(object):
+    """A boolean mask over a width x height box, used to blit a patch's tiles onto a map.
+
+    Each row is kept as a byte mask: an int with one byte per cell, most significant byte
+    first, that is 0x01 where the cell is set. This is the format TileGrid.blit consumes.
+    """
+    __slots__ = ('height', 'width', 'row_masks')
+
+    def __init__(self, rows):
+        #rows is a list of equal-length sequences of truthy/falsy values
+        self.height = len(rows)
+        self.width = len(rows[0]) if self.height > 0 else 0
+        self.row_masks = [int.from_bytes(bytes(1 if cell else 0 for cell in row), 'big') for row in rows]
+
+    @classmethod
+    def from_row_masks(cls, width, row_masks):
+        """Returns a Stencil with rows already in byte mask form"""
+        stencil = cls.__new__(cls)
+        stencil.height = len(row_masks)
+        stencil.width = width
+        stencil.row_masks = row_masks
+        return stencil
+
+    def is_set(self, x, y):
+        return bool((self.row_masks[y] >> (8 * (self.width - 1 - x))) & 1)
+
+    def cell_count(self):
+        """Returns the number of cells set"""
+        return sum(bin(mask).count('1') for mask in self.row_masks)
+
+
+def get_ribwidth(r, offset):
+    """Returns the perpendicular distance to the edge of a circle of radius r from a line
+    through the center of the circle at a given offset.
+    """
+    return int(math.sqrt(abs(r**2 - offset**2)))
+
+@functools.lru_cache(maxsize=STENCIL_CACHE_SIZE)
+def get_mesa_stencil(r):
+    """Returns the Stencil for a mesa of radius r, rasterizing it only the first time"""
+    rows = []
+    for circ_height in range(-r, r+1):
+        rib_width = get_ribwidth(r, circ_height)
+        rows.append([abs(circ_x) <= rib_width for circ_x in range(-r, r+1)])
+    return Stencil(rows)
+
+
 class Patch(object):
-    """A grid of tiles that can be added onto the map."""
+    """A grid of tiles that can be added onto the map.
+
+    Rather than a cell per tile, each row is stored as a tuple of (start, end, tile) spans,
+    covering x from start up to but not including end, in order. Empty cells take no space.
+    """
+    __slots__ = ('x', 'y', 'height', 'width', '_rows')
 
     def __init__(self, x, y, height, width):
         #x,y are the origin-tile in the upper-left corner.
@@ -13,57 +70,110 @@ class Patch(object):
         self.y = y
         self.height = height
         self.width = width
-        self._patch = [[None for i in range(self.width)]for j in range(self.height)]
+        self._rows = [()] * self.height
 
     def get(self, x, y):
-        return self._patch[y][x]
+        if not 0 <= x < self.width:
+            raise IndexError("x {0} is outside a patch {1} wide".format(x, self.width))
+        for start, end, tile in self._rows[y]:
+            if x < start:
+                break
+            if x < end:
+                return tile
+        return None
 
     def set(self, x, y, tile):
-        self._patch[y][x] = tile
+        self.set_span(y, x, x + 1, tile)
+
+    def set_span(self, y, start, end, tile):
+        """Sets the cells in row y from start up to but not including end to tile,
+        or empties them if tile is None
+        """
+        if not 0 <= start <= end <= self.width:
+            raise IndexError("Span {0}-{1} is outside a patch {2} wide".format(start, end, self.width))
+        spans = []
+        for span_start, span_end, span_tile in self._rows[y]:
+            #Keep whatever part of the existing span lies outside the new one
+            if span_start < start:
+                spans.append((span_start, min(span_end, start), span_tile))
+            if span_end > end:
+                spans.append((max(span_start, end), span_end, span_tile))
+        if tile is not None and start < end:
+            spans.append((start, end, tile))
+        spans.sort(key=lambda span: span[0])
+        merged = []
+        for span in spans:
+            if merged and merged[-1][1] == span[0] and merged[-1][2] is span[2]:
+                merged[-1] = (merged[-1][0], span[1], span[2])
+            else:
+                merged.append(span)
+        self._rows[y] = tuple(merged)
+
+    def get_stencils(self):
+        """Returns a list of (tile, Stencil) pairs covering every non-empty cell of the patch"""
+        masks = collections.OrderedDict()
+        for y, spans in enumerate(self._rows):
+            for start, end, tile in spans:
+                if tile not in masks:
+                    masks[tile] = [0] * self.height
+                #A run of 0x01 bytes, end - start long, ending width - end bytes from the right
+                masks[tile][y] |= (int.from_bytes(b'\x01' * (end - start), 'big') << (8 * (self.width - end)))
+        return [(tile, Stencil.from_row_masks(self.width, row_masks)) for tile, row_masks in masks.items()]
 
     def dbgoutput(self):
         dbgstr = "X:{0} Y:{1} width:{2} height:{3}".format(self.x, self.y, self.width, self.height)
         return dbgstr + '\n' + self.__str__()
 
+    def iter_lines(self):
+        """Yields the patch as text, one row at a time, with spaces for empty cells"""
+        for i_y in range(self.height):
+            tiles = (self.get(i_x, i_y) for i_x in range(self.width))
+            yield "".join([' ' if tile is None else tile.char for tile in tiles]) + '\n'
+
     def __str__(self):
-        patchstring = ""
-        for row in self._patch:
-            rowstring = ""
-            for tile in row:
-                if tile != None:
-                    rowstring += tile.char
-                else:
-                    rowstring += ' '
-            patchstring += rowstring
-            patchstring += '\n'
-        return patchstring
+        return "".join(self.iter_lines())
 
 
 class Mesa(Patch):
     """A circular island"""
+    __slots__ = ('r', '_stencil')
 
     def __init__(self, x, y, r):
         self.x = x
         self.y = y
-        self.center_x = self.x + r
-        self.center_y = self.y + r
 
         self.r = r
         self.width = (2*r)+1
         self.height = (2*r)+1
-        self._patch = [[None for i in range(self.width)]for j in range(self.height)]
+        #Mesas of the same radius share one cached stencil rather than each rasterizing a circle
+        self._stencil = get_mesa_stencil(r)
 
-        #Create the mesa, treating the center tile as the origin.
-        for circ_height in range(-self.r, self.r+1):
-            rib_width = int(self.get_ribwidth(circ_height))
-            for circ_x in range(-rib_width, rib_width+1):
-                self.set(circ_x+r, circ_height+r, TileManager.floor)
+    @property
+    def center_x(self):
+        return self.x + self.r
+
+    @property
+    def center_y(self):
+        return self.y + self.r
+
+    def get(self, x, y):
+        return TileManager.floor if self._stencil.is_set(x, y) else None
+
+    def set(self, x, y, tile):
+        raise TypeError("Mesas share a cached stencil and can't be edited tile by tile")
+
+    def set_span(self, y, start, end, tile):
+        #There are no spans to edit, only the shared stencil
+        raise TypeError("Mesas share a cached stencil and can't be edited tile by tile")
+
+    def get_stencils(self):
+        return [(TileManager.floor, self._stencil)]
 
     def get_ribwidth(self, offset):
         """Returns the perpendicular distance to the edge of the circle from a line
         through the center of the circle at a given offset.
         """
-        return int(math.sqrt(abs(self.r**2 - offset**2)))
+        return get_ribwidth(self.r, offset)
 
     def get_edge_coordinates(self, offset_from_center, axis, invert=False):
         """ Returns the coordinates of a point on the edge of the mesa perpendicular
@@ -82,14 +192,16 @@ class Mesa(Patch):
 
 class Bridge(Patch):
     """A straight row of walkable tiles; a rickety wooden bridge over the sea"""
+    __slots__ = ('length', 'direction')
 
     def __init__(self, x, y, length, direction):
         self.x = x
         self.y = y
 
         self.length = length
+        self.direction = direction
 
-        self._patch = [[]]
+        self._rows = []
         self.width = 0
         self.height = 0
         self._build_bridge(direction)
@@ -99,4 +211,10 @@ class Bridge(Patch):
         self.height = max(abs(self.length * direction[1]), 1)
         self.x = min(self.x, self.x + (self.length * direction[0]) + 1)
         self.y = min(self.y, self.y + (self.length * direction[1]) + 1)
-        self._patch = [[TileManager.bridge for i in range(self.width)]for j in range(self.height)]
+        #Every row is the same single span, so they can all share it
+        self._rows = [((0, self.width, TileManager.bridge),)] * self.height
+
+    def get_stencils(self):
+        #Every row is the same run of bridge, so there's only one row mask to work out
+        row_mask = int.from_bytes(b'\x01' * self.width, 'big')
+        return [(TileManager.bridge, Stencil.from_row_masks(self.width, [row_mask] * self.height))]
@@ -0,0 +1,151 @@
+"""Timing where each frame's time goes
+
+Instrumented code wraps each phase of a frame in `with profiling.phase("name"):`. While timing
+is off, phase() hands back one shared do-nothing context manager, so the instrumentation costs
+little more than a function call. While it's on, the latest durations of each phase are kept,
+for rolling percentiles in an overlay or exported as JSON.
+
+cProfile capture is separate and much heavier: toggle_cprofile() starts it, and calling it
+again stops it and dumps the stats to a file that pstats can read.
+"""
+import collections
+import cProfile
+import json
+import math
+import time
+
+#How many of the latest durations of each phase the stats are worked out from
+PHASE_WINDOW_SIZE = 300
+#Where captured cProfile stats are dumped
+CPROFILE_FILENAME = "dolmen-coast.prof"
+#Where timings are exported
+TIMINGS_FILENAME = "dolmen-coast-timings.json"
+
+class _NullPhase(object):
+    """Stands in for a phase while timing is off"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase(object):
+    """Times one run of a phase, adding the duration to its samples"""
+    __slots__ = ('samples', 'start')
+
+    def __init__(self, samples):
+        self.samples = samples
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.samples.append(time.perf_counter() - self.start)
+        return False
+
+
+def percentile(samples, fraction):
+    """Returns the sample that fraction of the samples are no greater than"""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+class Profiler(object):
+    """Rolling timings of named phases, plus an optional cProfile capture"""
+
+    def __init__(self, window_size=PHASE_WINDOW_SIZE):
+        self.enabled = False
+        self.window_size = window_size
+        #Phase name -> deque of its latest durations, in seconds
+        self._samples = collections.OrderedDict()
+        self._cprofile = None
+
+    def phase(self, group, name=None):
+        """Returns a context manager timing a phase. Phases that come in many kinds, such as
+        events, can give the kind as name, and are kept as "group:name".
+        """
+        if not self.enabled:
+            return _NULL_PHASE
+        key = group if name is None else group + ":" + name
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = collections.deque(maxlen=self.window_size)
+        return _Phase(samples)
+
+    def toggle(self):
+        """Turns timing on or off. Returns whether it's now on."""
+        self.enabled = not self.enabled
+        return self.enabled
+
+    def clear(self):
+        self._samples.clear()
+
+    def stats(self):
+        """Returns phase name -> dict of its count, mean, p50, p99 and max durations over
+        the window, in milliseconds
+        """
+        stats = collections.OrderedDict()
+        for key, samples in self._samples.items():
+            if len(samples) == 0:
+                continue
+            stats[key] = {
+                "count": len(samples),
+                "mean_ms": sum(samples) / len(samples) * 1000,
+                "p50_ms": percentile(samples, .5) * 1000,
+                "p99_ms": percentile(samples, .99) * 1000,
+                "max_ms": max(samples) * 1000,
+            }
+        return stats
+
+    def overlay_lines(self, limit=None):
+        """Returns the stats as lines of text, slowest phase by p99 first"""
+        stats = self.stats()
+        keys = sorted(stats, key=lambda key: stats[key]["p99_ms"], reverse=True)[:limit]
+        lines = ["{0:<24} {1:>5} {2:>8} {3:>8}".format("phase", "n", "p50 ms", "p99 ms")]
+        for key in keys:
+            phase_stats = stats[key]
+            lines.append("{0:<24.24} {1:>5} {2:>8.3f} {3:>8.3f}".format(
+                key, phase_stats["count"], phase_stats["p50_ms"], phase_stats["p99_ms"]))
+        return lines
+
+    def export_json(self, filename=TIMINGS_FILENAME, include_samples=False):
+        """Writes the stats, and optionally the durations behind them in seconds, to a JSON file"""
+        output = {"time": time.time(), "window_size": self.window_size, "phases": self.stats()}
+        if include_samples:
+            output["samples"] = dict((key, list(samples)) for key, samples in self._samples.items())
+        with open(filename, 'w') as out_file:
+            json.dump(output, out_file, indent=2)
+        return filename
+
+    def toggle_cprofile(self, filename=CPROFILE_FILENAME):
+        """Starts capturing with cProfile, or if it's already capturing, stops and dumps the
+        stats to filename. Returns filename once dumped, or None on starting.
+        """
+        if self._cprofile is None:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+            return None
+        self._cprofile.disable()
+        self._cprofile.dump_stats(filename)
+        self._cprofile = None
+        return filename
+
+    @property
+    def capturing(self):
+        return self._cprofile is not None
+
+
+#The profiler the module-level functions use
+__profiler = Profiler()
+
+def get_profiler():
+    return __profiler
+
+def phase(group, name=None):
+    """Returns a context manager timing a phase, see Profiler.phase"""
+    return __profiler.phase(group, name)
@@ -0,0 +1,145 @@
+"""Finds paths for bridges across the sea between mesas"""
+import heapq
+
+from tilemanager import TileManager
+
+#Extra cost for changing direction, so bridges come out as a few long, straight runs
+TURN_COST = 1
+#How much the search trusts its distance estimate. Above 1, it heads straight for the goal instead
+#of checking every equally short way around an obstacle, and paths may come out up to this many
+#times longer than the shortest.
+HEURISTIC_WEIGHT = 2
+
+#Step offsets, indexed by direction number. The came-from buffer stores these numbers, plus one.
+_STEPS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+class BridgeRouter(object):
+    """A* pathfinding over a TileGrid, through tiles bridges are allowed to cross.
+
+    The visited-stamp and came-from buffers are allocated once, at the size of the whole grid,
+    and reused by every route() call, as is the open set. A search is only ever as big as the
+    box it's given, so a router can be used for thousands of joins without allocating per call.
+    """
+
+    def __init__(self, grid, passable_tiles=(TileManager.impass, TileManager.bridge)):
+        self.grid = grid
+        self._passable_codes = frozenset(tile.code for tile in passable_tiles)
+        size = grid.width * grid.height
+        #A cell has been visited in the current search if its stamp equals _stamp
+        self._stamps = bytearray(size)
+        self._stamp = 0
+        #Direction number + 1 of the step that first reached each visited cell, 0 for a start cell
+        self._came_from = bytearray(size)
+        self._open_set = []
+
+    def route(self, starts, goals, box):
+        """Returns the list of (x, y) cells on a path from one of the start cells to one of the
+        goal cells, or None if there isn't one.
+
+        starts and goals are iterables of (x, y) cells. Only passable cells inside box, an
+        (x, y, width, height) tuple, are searched. Paths prefer few turns (see TURN_COST) and are
+        close to, but not always, the shortest (see HEURISTIC_WEIGHT).
+        """
+        grid = self.grid
+        width = grid.width
+        codes = grid.raw_codes()
+        passable = self._passable_codes
+        box_left, box_top = max(box[0], 0), max(box[1], 0)
+        box_right = min(box[0] + box[2], grid.width)
+        box_bottom = min(box[1] + box[3], grid.height)
+
+        goal_indices = set(y * width + x for x, y in goals
+                            if box_left <= x < box_right and box_top <= y < box_bottom and codes[y * width + x] in passable)
+        if not goal_indices:
+            return None
+        #Distance to the box around the goals, which never overestimates before weighting
+        goal_xs = [index % width for index in goal_indices]
+        goal_ys = [index // width for index in goal_indices]
+        goal_left, goal_right = min(goal_xs), max(goal_xs)
+        goal_top, goal_bottom = min(goal_ys), max(goal_ys)
+        def heuristic(x, y):
+            return HEURISTIC_WEIGHT * ((goal_left - x if x < goal_left else x - goal_right if x > goal_right else 0) +
+                                        (goal_top - y if y < goal_top else y - goal_bottom if y > goal_bottom else 0))
+
+        stamps = self._stamps
+        came_from = self._came_from
+        stamp = self._next_stamp()
+        open_set = self._open_set
+        del open_set[:]
+
+        for x, y in starts:
+            if box_left <= x < box_right and box_top <= y < box_bottom and codes[y * width + x] in passable:
+                open_set.append((heuristic(x, y), 0, x, y, -1))
+        heapq.heapify(open_set)
+
+        #Entries are (estimated total cost, -cost so far, x, y, direction). Open sea is full of
+        #equally good paths, so break ties toward whichever has got furthest along, or the
+        #search fans out over the whole box.
+        while open_set:
+            _, cost, x, y, direction = heapq.heappop(open_set)
+            cost = -cost
+            index = y * width + x
+            if stamps[index] == stamp:
+                continue
+            stamps[index] = stamp
+            came_from[index] = direction + 1
+            if index in goal_indices:
+                return self._trace_path(x, y)
+            for step_direction, (step_x, step_y) in enumerate(_STEPS):
+                next_x = x + step_x
+                next_y = y + step_y
+                if not (box_left <= next_x < box_right and box_top <= next_y < box_bottom):
+                    continue
+                next_index = next_y * width + next_x
+                if stamps[next_index] == stamp or codes[next_index] not in passable:
+                    continue
+                next_cost = cost + 1 + (TURN_COST if direction not in (-1, step_direction) else 0)
+                heapq.heappush(open_set, (next_cost + heuristic(next_x, next_y), -next_cost, next_x, next_y, step_direction))
+        return None
+
+    def _next_stamp(self):
+        """Starts a new search, clearing the stamp buffer when the one-byte stamps run out"""
+        self._stamp += 1
+        if self._stamp > 255:
+            self._stamps[:] = bytes(len(self._stamps))
+            self._stamp = 1
+        return self._stamp
+
+    def _trace_path(self, x, y):
+        """Walks the came-from buffer back from x, y to a start cell"""
+        width = self.grid.width
+        path = [(x, y)]
+        direction = self._came_from[y * width + x] - 1
+        while direction >= 0:
+            step_x, step_y = _STEPS[direction]
+            x -= step_x
+            y -= step_y
+            path.append((x, y))
+            direction = self._came_from[y * width + x] - 1
+        path.reverse()
+        return path
+
+
+def path_to_segments(path):
+    """Splits a path of orthogonally adjacent cells into straight runs.
+
+    Returns a list of (x, y, length, direction) tuples, one per run, in the form Bridge takes.
+    """
+    if not path:
+        return []
+    segments = []
+    start = path[0]
+    direction = None
+    length = 1
+    for previous, cell in zip(path, path[1:]):
+        step = (cell[0] - previous[0], cell[1] - previous[1])
+        if direction is None or step == direction:
+            direction = step
+            length += 1
+        else:
+            segments.append((start[0], start[1], length, direction))
+            start = previous
+            direction = step
+            length = 2
+    segments.append((start[0], start[1], length, direction or (1, 0)))
+    return segments
@@ -1,9 +1,75 @@
 """A module for the panels that make up the game interface"""
+import asyncio
 import collections
 import curses
+import functools
+import itertools
+import re
 
 import events
 
+#How many wrapped messages to remember, see wrap_message
+WRAP_CACHE_SIZE = 1024
+
+@functools.lru_cache(maxsize=WRAP_CACHE_SIZE)
+def wrap_message(message, width, height, more_indicator=None):
+    """Wraps a message into at most height rows of text, each shorter than width.
+
+    Every row starts with a space. Words that are too long for a row are broken with a hyphen,
+    and a newline always starts a new row, even at the end of the message, where it leaves a
+    blank row. If more_indicator is given, the last row is saved for it in case the message
+    doesn't fit.
+
+    Returns a tuple of the rows and the text that didn't fit, or None if it all did.
+    Results are cached, since the same text tends to get drawn over and over.
+    """
+    rows = []
+    max_rows = height - 1 if more_indicator is not None else height
+    #Room for a piece of a long word, after the leading space and with a hyphen
+    piece_length = width - 3
+    position = 0
+    end = len(message)
+    #The message ends in an empty word, just as it would after a trailing newline or space,
+    #so position only goes past end once the last word has been put in a row
+    while len(rows) < max_rows and position <= end:
+        row = ""
+        while position <= end:
+            #Find the end of the next word, at a space, a newline or the end of the message
+            word_end = end
+            space = message.find(' ', position, word_end)
+            if space >= 0:
+                word_end = space
+            newline = message.find('\n', position, word_end)
+            if newline >= 0:
+                word_end = newline
+            word_length = word_end - position
+            if len(row) + 1 + word_length < width:
+                row += " " + message[position:word_end]
+                position = word_end + 1
+                if newline >= 0:
+                    break
+            elif row == "":
+                #Rather than choke forever on a string too long to print but too stubborn to die,
+                #print as much of the word as fits, and carry on with the rest on the next row.
+                if piece_length < 1:
+                    #Not even one letter fits
+                    return (tuple(rows), message[position:])
+                row = " " + message[position:position + piece_length] + '-'
+                position += piece_length
+                break
+            else:
+                break
+        rows.append(row)
+
+    remaining_text = message[position:] if position <= end else None
+
+    #Optionally put a message at the bottom of the window if there is more text
+    if more_indicator is not None and remaining_text is not None:
+        rows.append(more_indicator.center(width-1))
+
+    return (tuple(rows), remaining_text)
+
+
 class TextPanel():
     """Displays and formats text in a curses window"""
 
@@ -12,6 +78,12 @@ class TextPanel():
         #The height within the window where the next line
         #of text should be drawn:
         self.next_line = 1 #1 not 0, to account for window border
+        #Whether the window needs redrawing
+        self._changed = False
+
+    def mark_changed(self):
+        """Have the panel redrawn in full next time it's displayed"""
+        self._changed = True
 
     def display():
         """Called by the game loop. Should print appropriate text
@@ -31,56 +103,9 @@ class TextPanel():
         #Account for border
         width -= 2
         height -= 2
-
-        #Turn the message into an array of words, and reverse it so that
-        #we can consume from the end
-        message = message.split(' ')
-        message.reverse()
-
-        message_rows = collections.deque()
-        #Leave space for a "==MORE==" message if necessary
-        adjusted_height = height-1 if more_indicator is not None else height
-        #Break the message into lines
-        while len(message_rows) < (adjusted_height) and len(message) > 0:
-            new_row = ""
-            while len(message) > 0:
-                #Put words into the current row's string
-                #Break if putting another word in would overflow the width
-                #Also break on a newline
-                if len(new_row) + 1 + len(message[-1]) < width:
-                    word = message.pop()
-                    words = word.split('\n', 1)
-                    new_row += " " + words[0]
-                    if len(words) > 1:
-                        for word in words[1:]:
-                            message.append(word)
-                        break
-                elif new_row == "":
-                    #Rather than choke forever on a string too long to print but too stubborn to die,
-                    #if we haven't added any words at all this iteration, break the first word into 
-                    #two words and try again.
-                    stupid_long_word = message.pop()
-                    first_part = stupid_long_word[:width-2] + '-'
-                    second_part = stupid_long_word[width-2:]
-                    message.append(second_part)
-                    message.append(first_part)
-                else:
-                    break
-            message_rows.append(new_row)
-
-        #We should now have an array of strings, each of which represents a row of text
-        #that will fit in the window. If there's any more of the message left, return it
-        #as the second part of the tuple.
-        remaining_text = None
-        if len(message) > 0:
-            message.reverse()
-            remaining_text = " ".join(message)
-
-        #Optionally put a message at the bottom of the window if there is more text
-        if more_indicator is not None and remaining_text is not None:
-            message_rows.append(more_indictaor.center(width-1))
-
-        return (message_rows, remaining_text)
+        message_rows, remaining_text = wrap_message(message, width, height, more_indicator)
+        #Callers consume the rows, so they get their own copy of the cached ones
+        return (collections.deque(message_rows), remaining_text)
 
     def _display_message(self, message_rows):
         """Print the text line by line into the window"""
@@ -101,20 +126,39 @@ class MessagePanel(TextPanel):
         super(MessagePanel, self).__init__(window)
         self._message_queue = collections.deque()
         self.more_messages_string = "==MORE=="
+        #The rows of the message on screen, if any
+        self._page = None
+        #Set when a message arrives, once run() has started
+        self._wakeup = None
 
         events.listen_to_event("print_message", self.add_message)
 
     def add_message(self, text):
         """Add a message to be displayed next turn"""
         self._message_queue.append(text)
+        if self._wakeup is not None:
+            self._wakeup.set()
 
     def display(self):
-        """Display all messages in the queue in FIFO order, pausing to wait for keystrokes
-        after each one
-        """
-        #Can't use the 'for in' syntax, since we want to pop
-        while len(self._message_queue) > 0:
+        """Draw the message being shown, if it's changed"""
+        if not self._changed:
+            return
+        self._changed = False
+        self.window.clear()
+        if self._page is not None:
             self.window.border()
+            self._display_message(collections.deque(self._page))
+            self._reset_line_position()
+        self.window.refresh()
+
+    async def run(self, game_loop):
+        """Show the messages in the queue in FIFO order, waiting for a keypress after each one"""
+        self._wakeup = asyncio.Event()
+        while True:
+            if len(self._message_queue) == 0:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
             message = self._message_queue.popleft()
             message_rows, remaining = self._trim_message(message)
             if remaining is not None:
@@ -122,19 +166,23 @@ class MessagePanel(TextPanel):
                 #it can go straight to the front, enjoying all the envious
                 #looks that the rest of the text gives it.
                 self._message_queue.appendleft(remaining)
-            self._display_message(message_rows)
-            self.window.getkey()
-            self.window.clear()
-            self._reset_line_position()
-        self.window.refresh()
+            self._show(message_rows, game_loop)
+            await game_loop.keys.get_key(modal=True)
+            self._show(None, game_loop)
+
+    def _show(self, message_rows, game_loop):
+        self._page = message_rows
+        self._changed = True
+        game_loop.request_redraw()
 
 ##=======================================================##
 
 class ListMenu(TextPanel):
     """Displays a list of selectable options"""
 
-    class ListMenuItem():
+    class ListMenuItem(object):
         """A selectable option in a ListMenu"""
+        __slots__ = ('text', 'action')
 
         def __init__(self, text, action):
             self.text = text
@@ -147,6 +195,8 @@ class ListMenu(TextPanel):
         self.header = None
         self.menu_list = [] if menu_list is None else menu_list
         self.footer = None
+        #Set when a new list arrives, once run() has started
+        self._wakeup = None
 
         events.listen_to_event("print_list", self.set_list)
 
@@ -160,27 +210,31 @@ class ListMenu(TextPanel):
         if footer is not None and len(footer) > 0:
             self.footer, _ = self._trim_message(footer)
         self.active = True
+        self._changed = True
+        if self._wakeup is not None:
+            self._wakeup.set()
 
     def display(self):
-        """Draw the list items to the screen"""
+        """Draw the list items to the screen, if they've changed"""
+        if not self._changed:
+            return
+        self._changed = False
+        self.window.clear()
         if self.active:
             self.window.border()
             if self.header is not None:
-                self._display_message(self.header)
+                self._display_message(collections.deque(self.header))
             for idx, option in enumerate(self.menu_list):
                 message = "{0}. {1}".format(idx, option.text)
                 message_rows, _ = self._trim_message(message)
                 self._display_message(message_rows)
             if self.footer is not None:
-                self._display_message(self.footer)
-            self.handle_key(self.window.getkey())
+                self._display_message(collections.deque(self.footer))
             self._reset_line_position()
-            self.window.clear()
-            self.active = False
-            self.window.refresh()
+        self.window.refresh()
 
     def handle_key(self, key):
-        """Handle keyboard input for the menu"""
+        """Handle keyboard input for the menu. Returns whether the menu is finished with."""
         number = None
         try:
             number = int(key)
@@ -190,21 +244,57 @@ class ListMenu(TextPanel):
 
         if number is not None and 0 <= number < len(self.menu_list):
             self.menu_list[number].action()
-        elif key in ["q", "KEY_ESC"]:
-            pass
-        else:
-            self.handle_key(self.window.getkey())
+            return True
+        return key in ["q", "KEY_ESC"]
+
+    async def run(self, game_loop):
+        """Wait for a list to be set, then for keys until one of its options is chosen"""
+        self._wakeup = asyncio.Event()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            menu_list = self.menu_list
+            game_loop.request_redraw()
+            while not self.handle_key(await game_loop.keys.get_key(modal=True)):
+                pass
+            #The chosen action might have put up a new list, which stays
+            if self.menu_list is menu_list:
+                self.active = False
+                self._changed = True
+            events.process_deferred_events()
+            game_loop.request_redraw()
 
 ##=======================================================##
 
+#Matches a run of one repeated byte
+_SAME_BYTE_RUN = re.compile(rb'(.)\1*', re.DOTALL)
+
 class GamePanel():
     """ Shows the game world. This is the main game screen. """
 
     def __init__(self, window):
         self.window = window
-
-    def display(self, maparray, center_on_coords=None):
-
+        #What was on screen after the last display(), so the next one can redraw only what changed
+        self._last_maparray = None
+        self._last_view = None
+        #Map row y -> list of (x, text, color) runs of same-colored tiles across the view
+        self._row_runs = {}
+        #Translation tables for turning rows of tile codes straight into runs, see _get_code_tables
+        self._code_tables = None
+        #The FieldOfView and VisibleArea the last display() showed
+        self._last_visibility = None
+        self._last_visible = None
+
+    def display(self, maparray, center_on_coords=None, dirty_rects=None, visibility=None):
+        """Draws the part of the map around center_on_coords.
+
+        dirty_rects is a list of (x, y, width, height) map regions that changed since the last
+        call, as returned by DirtyRegions.take(). If it's given, only those regions and whatever
+        scrolled into view get redrawn. If it's None, the whole view is redrawn.
+
+        visibility is an optional fov.FieldOfView. If it's given, only the cells it can see
+        right now are drawn normally; cells seen before are drawn dim, and the rest are blank.
+        """
         w_height, w_width = self.window.getmaxyx()
         m_height = len(maparray)
         m_width = len(maparray[0])
@@ -223,13 +313,179 @@ class GamePanel():
         max_y_offset = m_height - w_height
         y_offset = max(center_y - w_height//2, 0) #Top edge
         y_offset = min(y_offset, max_y_offset) #Bottom edge
-    
-        #Iterate over the generated map and display a subset of its contents 
-        #that fits in the game window
-        for y, row in enumerate(maparray[y_offset:y_offset + w_height - 1]):
-            for x, tile in enumerate(row[x_offset:x_offset + w_width - 1]):
-                try:
-                    self.window.addch(y, x, tile.char, tile.color)
-                except TypeError:
-                    raise TypeError("X:{0} Y:{1} char:{2} color:{3}".format(x, y, tile.char, tile.color))
 
+        #The area of the map we draw, in map coordinates
+        view = (x_offset, y_offset, min(w_width - 1, m_width - x_offset), min(w_height - 1, m_height - y_offset))
+        last_view = self._last_view
+        if dirty_rects is not None and visibility is not self._last_visibility:
+            dirty_rects = None
+        visible = None if visibility is None else visibility.visible
+        if dirty_rects is not None and visible is not self._last_visible:
+            #Cells that came into or went out of sight need redrawing, just like changed ones.
+            #The old and new areas mostly overlap, so they're redrawn as one box rather than two.
+            boxes = [area.box() for area in (self._last_visible, visible) if area is not None]
+            left = min(box[0] for box in boxes)
+            top = min(box[1] for box in boxes)
+            right = max(box[0] + box[2] for box in boxes)
+            bottom = max(box[1] + box[3] for box in boxes)
+            dirty_rects = dirty_rects + [(left, top, right - left, bottom - top)]
+        self._last_visibility = visibility
+        self._last_visible = visible
+        if (dirty_rects is None or maparray is not self._last_maparray or last_view is None
+                or view[0] != last_view[0] or view[2] != last_view[2] or x_offset < 0 or y_offset < 0):
+            self._row_runs = {}
+        else:
+            for rect in dirty_rects:
+                for y in range(rect[1], rect[1] + rect[3]):
+                    self._row_runs.pop(y, None)
+
+        full_redraw = (dirty_rects is None or maparray is not self._last_maparray or last_view is None
+                        or view[2:] != last_view[2:] or x_offset < 0 or y_offset < 0)
+        if not full_redraw:
+            x_shift = x_offset - last_view[0]
+            y_shift = y_offset - last_view[1]
+            if abs(x_shift) >= view[2] or abs(y_shift) >= view[3]:
+                full_redraw = True
+            elif x_shift or y_shift:
+                self._shift_view(x_shift, y_shift, view)
+                #Draw the strips that scrolled into view
+                exposed_x = x_offset + view[2] - x_shift if x_shift > 0 else x_offset
+                exposed_y = y_offset + view[3] - y_shift if y_shift > 0 else y_offset
+                dirty_rects = dirty_rects + [(exposed_x, y_offset, abs(x_shift), view[3]),
+                                            (x_offset, exposed_y, view[2], abs(y_shift))]
+        self._last_maparray = maparray
+        self._last_view = view
+
+        if full_redraw:
+            dirty_rects = [view]
+        for rect in dirty_rects:
+            self._draw_region(maparray, rect, view, visibility)
+
+        #Forget rows that scrolled out of view
+        if len(self._row_runs) > view[3]:
+            self._row_runs = dict((y, runs) for y, runs in self._row_runs.items() if y_offset <= y < y_offset + view[3])
+
+    def _draw_region(self, maparray, rect, view, visibility=None):
+        """Draws the part of a map region that lies inside the view"""
+        x_offset, y_offset, view_width, view_height = view
+        left = max(rect[0], x_offset)
+        right = min(rect[0] + rect[2], x_offset + view_width)
+        top = max(rect[1], y_offset)
+        bottom = min(rect[1] + rect[3], y_offset + view_height)
+        if left >= right or top >= bottom:
+            return
+        for y, row in enumerate(maparray[top:bottom], top):
+            runs = self._row_runs.get(y)
+            if runs is None:
+                runs = self._get_row_runs(row, x_offset, view_width)
+                if visibility is not None:
+                    runs = self._shade_runs(runs, visibility.row_states(y, x_offset, x_offset + view_width), x_offset)
+                self._row_runs[y] = runs
+            if left == x_offset and right == x_offset + view_width:
+                #The whole row is being drawn, so there's no clipping to do
+                for run_x, text, color in runs:
+                    self._addstr(y - y_offset, run_x - x_offset, text, color)
+                continue
+            for run_x, text, color in runs:
+                #Clip the run to the region
+                start = max(left - run_x, 0)
+                end = min(right - run_x, len(text))
+                if start < end:
+                    self._addstr(y - y_offset, run_x - x_offset + start, text[start:end], color)
+
+    def _addstr(self, y, x, text, color):
+        try:
+            self.window.addstr(y, x, text, color)
+        except TypeError:
+            raise TypeError("X:{0} Y:{1} text:{2} color:{3}".format(x, y, text, color))
+
+    def _get_row_runs(self, row, x_offset, view_width):
+        """Splits the visible part of a map row into runs of tiles that share a color,
+        so that each run can be drawn with one addstr instead of an addch per tile.
+
+        Returns a list of (x, text, color) tuples, with x in map coordinates.
+        """
+        runs = []
+        run_x = x_offset
+        code_tables = self._get_code_tables(row)
+        if code_tables is not None:
+            #Rows of tile codes can be split up without looking at each tile in Python
+            char_table, color_table, colors = code_tables
+            codes = row.codes()[x_offset:x_offset + view_width]
+            text = codes.translate(char_table).decode('latin-1')
+            for run in _SAME_BYTE_RUN.finditer(codes.translate(color_table)):
+                start, end = run.span()
+                runs.append((run_x + start, text[start:end], colors[codes[start]]))
+            return runs
+        for color, tiles in itertools.groupby(row[x_offset:x_offset + view_width], key=lambda tile: tile.color):
+            text = "".join(tile.char for tile in tiles)
+            runs.append((run_x, text, color))
+            run_x += len(text)
+        return runs
+
+    def _shade_runs(self, runs, states, x_offset):
+        """Splits runs where the visibility of their cells changes. states is the row's cells'
+        visibility from FieldOfView.row_states. Visible cells are left alone, remembered cells
+        are dimmed, and cells never seen become blank.
+        """
+        if states.count(2) == len(states):
+            return runs
+        shaded = []
+        for run_x, text, color in runs:
+            start = run_x - x_offset
+            for state_run in _SAME_BYTE_RUN.finditer(states, start, start + len(text)):
+                state_start, state_end = state_run.span()
+                state = states[state_start]
+                if state == 2:
+                    shaded.append((x_offset + state_start, text[state_start - start:state_end - start], color))
+                elif state == 1:
+                    shaded.append((x_offset + state_start, text[state_start - start:state_end - start], (color or 0) | curses.A_DIM))
+                else:
+                    shaded.append((x_offset + state_start, ' ' * (state_end - state_start), 0))
+        return shaded
+
+    def _get_code_tables(self, row):
+        """For rows that can hand over their raw tile codes (TileRow), returns tables to
+        translate those codes into characters and into one byte per distinct color, plus
+        the color of each code. Returns None for other rows, or if a tile's character
+        doesn't fit in a byte.
+        """
+        if not hasattr(row, "codes"):
+            return None
+        palette = row.grid.palette
+        key = (id(palette), tuple((tile.char, tile.color) for tile in palette))
+        if self._code_tables is None or self._code_tables[0] != key:
+            tables = None
+            if len(palette) <= 256 and all(len(tile.char) == 1 and ord(tile.char) < 256 for tile in palette):
+                char_table = bytearray(256)
+                color_table = bytearray(256)
+                color_ids = {}
+                for code, tile in enumerate(palette):
+                    char_table[code] = ord(tile.char)
+                    color_table[code] = color_ids.setdefault(tile.color, len(color_ids))
+                tables = (bytes(char_table), bytes(color_table), [tile.color for tile in palette])
+            self._code_tables = (key, tables)
+        return self._code_tables[1]
+
+    def _shift_view(self, x_shift, y_shift, view):
+        """Moves what's already drawn in the window to match a view that has scrolled
+        by x_shift, y_shift tiles, so that only the newly exposed strips need drawing.
+        """
+        _, _, view_width, view_height = view
+        if y_shift:
+            self.window.scrollok(True)
+            self.window.scroll(y_shift)
+            self.window.scrollok(False)
+            if y_shift < 0:
+                #The view's bottom row got pushed into the spare row below it
+                self.window.move(view_height, 0)
+                self.window.clrtoeol()
+        for y in range(view_height):
+            for i in range(abs(x_shift)):
+                if x_shift > 0:
+                    self.window.delch(y, 0)
+                else:
+                    self.window.insch(y, 0, ' ')
+            if x_shift < 0:
+                #Likewise the view's rightmost column, into the spare column
+                self.window.delch(y, view_width)
@@ -0,0 +1,138 @@
+"""A spatial index for finding patches on the map without comparing every pair of them"""
+import collections
+
+#Unit vectors for each compass direction, in map coordinates
+DIRECTIONS = {'N': (0, -1),
+            'E': (1, 0),
+            'S': (0, 1),
+            'W': (-1, 0)}
+
+class PatchIndex(object):
+    """A uniform grid of buckets over placed patches.
+
+    Works with anything that has x, y, width and height, such as Mesas and Bridges.
+    Each patch is filed in every bucket its bounding box touches, so a query only has
+    to look at the buckets its own area touches.
+    """
+
+    def __init__(self, bucket_size=16):
+        self.bucket_size = bucket_size
+        #(bucket_x, bucket_y) -> list of patches
+        self._buckets = collections.defaultdict(list)
+        self._count = 0
+        #Bounds of the buckets in use, so directional searches know when to give up
+        self._min_bucket = None
+        self._max_bucket = None
+
+    def __len__(self):
+        return self._count
+
+    def insert(self, patch):
+        keys = self._bucket_keys(patch.x, patch.y, patch.width, patch.height)
+        for key in keys:
+            self._buckets[key].append(patch)
+        self._count += 1
+        first, last = keys[0], keys[-1]
+        if self._min_bucket is None:
+            self._min_bucket, self._max_bucket = first, last
+        else:
+            self._min_bucket = (min(self._min_bucket[0], first[0]), min(self._min_bucket[1], first[1]))
+            self._max_bucket = (max(self._max_bucket[0], last[0]), max(self._max_bucket[1], last[1]))
+
+    def remove(self, patch):
+        """Removes a patch that was inserted earlier. Raises ValueError if it wasn't."""
+        for key in self._bucket_keys(patch.x, patch.y, patch.width, patch.height):
+            bucket = self._buckets.get(key)
+            if bucket is None or not any(other is patch for other in bucket):
+                raise ValueError("Patch is not in the index: {0}".format(patch.dbgoutput() if hasattr(patch, "dbgoutput") else patch))
+            del bucket[next(i for i, other in enumerate(bucket) if other is patch)]
+            if len(bucket) == 0:
+                del self._buckets[key]
+        self._count -= 1
+
+    def query_range(self, x, y, width, height):
+        """Returns the patches whose bounding boxes share at least one tile with the given box"""
+        found = collections.OrderedDict()
+        for key in self._bucket_keys(x, y, width, height):
+            for patch in self._buckets.get(key, ()):
+                if id(patch) not in found and _boxes_intersect(patch, x, y, width, height):
+                    found[id(patch)] = patch
+        return list(found.values())
+
+    def overlapping(self, patch):
+        """Returns the other patches whose bounding boxes share a tile with this one's"""
+        return [other for other in self.query_range(patch.x, patch.y, patch.width, patch.height) if other is not patch]
+
+    def nearest_colinear(self, patch, direction):
+        """Returns the nearest patch in direction 'N', 'E', 'S' or 'W' that a straight line
+        in that direction from this patch would hit, or None if there isn't one.
+
+        Only patches lying entirely beyond this one's edge count, and their span across
+        the direction of travel has to overlap this patch's. Ties go to the patch nearest
+        the top-left.
+        """
+        step_x, step_y = DIRECTIONS[direction]
+        if self._count == 0:
+            return None
+        #Work along one axis, where 0 is x and 1 is y
+        axis = 0 if step_x != 0 else 1
+        sign = step_x + step_y
+        size = self.bucket_size
+        near_edge = _low(patch, axis) + _extent(patch, axis) if sign > 0 else _low(patch, axis)
+        perp_low = _low(patch, 1 - axis)
+        perp_high = perp_low + max(_extent(patch, 1 - axis), 1)
+
+        first_perp_bucket = perp_low // size
+        last_perp_bucket = (perp_high - 1) // size
+        bucket = near_edge // size if sign > 0 else (near_edge - 1) // size
+        last_bucket = self._max_bucket[axis] if sign > 0 else self._min_bucket[axis]
+
+        best = None
+        best_key = None
+        while (bucket <= last_bucket) if sign > 0 else (bucket >= last_bucket):
+            for perp_bucket in range(first_perp_bucket, last_perp_bucket + 1):
+                key = (bucket, perp_bucket) if axis == 0 else (perp_bucket, bucket)
+                for other in self._buckets.get(key, ()):
+                    if other is patch:
+                        continue
+                    other_perp_low = _low(other, 1 - axis)
+                    if other_perp_low >= perp_high or other_perp_low + max(_extent(other, 1 - axis), 1) <= perp_low:
+                        continue
+                    if sign > 0:
+                        gap = _low(other, axis) - near_edge
+                    else:
+                        gap = near_edge - (_low(other, axis) + _extent(other, axis))
+                    if gap < 0:
+                        continue
+                    other_key = (gap, other.y, other.x)
+                    if best_key is None or other_key < best_key:
+                        best, best_key = other, other_key
+            #Patches we haven't seen yet all lie beyond this bucket, so none can be closer
+            #than its far edge
+            closest_unseen = (bucket + 1) * size - near_edge if sign > 0 else near_edge - bucket * size
+            if best_key is not None and best_key[0] <= closest_unseen:
+                break
+            bucket += sign
+        return best
+
+    def _bucket_keys(self, x, y, width, height):
+        """Returns the keys of every bucket a box touches, top-left first and bottom-right last.
+        Empty boxes are treated as a single tile.
+        """
+        size = self.bucket_size
+        last_x = x + max(width, 1) - 1
+        last_y = y + max(height, 1) - 1
+        return [(bucket_x, bucket_y)
+                for bucket_y in range(y // size, last_y // size + 1)
+                for bucket_x in range(x // size, last_x // size + 1)]
+
+
+def _low(patch, axis):
+    return patch.x if axis == 0 else patch.y
+
+def _extent(patch, axis):
+    return patch.width if axis == 0 else patch.height
+
+def _boxes_intersect(patch, x, y, width, height):
+    return (patch.x < x + max(width, 1) and x < patch.x + max(patch.width, 1) and
+            patch.y < y + max(height, 1) and y < patch.y + max(patch.height, 1))
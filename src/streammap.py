@@ -0,0 +1,161 @@
+"""A map generated a band of rows at a time, for maps far bigger than memory
+
+A StreamedMap is never held whole. Mesas are placed band by band, each band's from its own
+generator as in Gamemap's parallel generation, so they come out sorted by band without the
+whole map's worth of them ever existing at once. Each band is then drawn with only the mesas
+and bridges that reach into it, walled using the floor of the rows just above and below it,
+and handed over before the next band is drawn. Only a few bands' worth of tiles and mesas are
+in memory at any time, however big the map.
+
+Without bridges, a StreamedMap comes out the same as a Gamemap with the same seed generated
+with workers. Bridges can't be planned over the whole map at once, so each band's mesas are
+bridged to their nearest neighbours east and south of them, within a window of the bands
+either side, joining only mesas that the window's bridges haven't joined already.
+"""
+import random
+
+from patches import Mesa, get_mesa_stencil
+from tilemanager import TileManager
+from tilegrid import TileGrid
+from spatialindex import PatchIndex
+from gamemap import GENERATION_BAND_HEIGHT, Gamemap, build_walls, plan_bridge, _place_band_mesas
+
+class StreamedMap(object):
+    """A map that can only be read once, from top to bottom, a band at a time"""
+
+    mesa_max_radius = Gamemap.mesa_max_radius
+    mesa_map_density = Gamemap.mesa_map_density
+    connect_islands = Gamemap.connect_islands
+
+    def __init__(self, width, height, seed=None):
+        """seed is a value or a random.Random instance, as for Gamemap"""
+        #Mesas from one band must never reach past the next
+        if 2*self.mesa_max_radius + 1 > GENERATION_BAND_HEIGHT:
+            raise ValueError("Mesas of radius {0} are too big for bands {1} high".format(self.mesa_max_radius, GENERATION_BAND_HEIGHT))
+        self.width = width
+        self.height = height
+        if isinstance(seed, random.Random):
+            #Bands seed their own generators from a plain value, as in Gamemap._create_map_parallel
+            seed = seed.getrandbits(64)
+        elif seed is None:
+            seed = random.Random().getrandbits(64)
+        self.seed = seed
+        self.band_count = (height + GENERATION_BAND_HEIGHT - 1) // GENERATION_BAND_HEIGHT
+
+    def iter_bands(self):
+        """Yields (top, band) for each band of the map from top to bottom, where band is a
+        TileGrid of the map's rows from top on. Each band is finished with, walls and all.
+        """
+        #band -> list of the Mesas placed in it, for the bands still needed
+        mesas = {}
+        #band -> list of (bridge, mesa, mesa2) for the bridges planned from that band's mesas
+        bridges = {}
+        top_floor = None
+        above_floor = 0
+        pending = None
+        for band in range(self.band_count + 1):
+            if band < self.band_count:
+                for needed in range(band - 1, band + 2):
+                    if 0 <= needed < self.band_count and needed not in mesas:
+                        mesas[needed] = self._place_mesas(needed)
+                bridges[band] = self._plan_bridges(band, mesas, bridges.get(band - 1, ())) if self.connect_islands else []
+                grid = self._draw_band(band, mesas, bridges)
+                floor = grid.row_mask(0, [TileManager.floor])
+                if top_floor is None:
+                    top_floor = floor
+                #Forget what no later band can reach
+                mesas.pop(band - 1, None)
+                bridges.pop(band - 1, None)
+            else:
+                #Like Gamemap's walls, the top row wraps around to wall in the bottom one
+                grid, floor = None, top_floor
+            if pending is not None:
+                pending_top, pending_grid = pending
+                last_floor = pending_grid.row_mask(pending_grid.height - 1, [TileManager.floor])
+                build_walls(pending_grid, above_floor=above_floor, below_floor=floor)
+                above_floor = last_floor
+                yield pending_top, pending_grid
+            pending = None if grid is None else (band * GENERATION_BAND_HEIGHT, grid)
+
+    def iter_lines(self):
+        """Yields the map as text, one row at a time, each line ending in a newline"""
+        for top, band in self.iter_bands():
+            for line in band.iter_lines():
+                yield line
+
+    def write_to(self, fileobj):
+        """Writes the map as text to a file opened in text mode, a band at a time"""
+        for line in self.iter_lines():
+            fileobj.write(line)
+
+    def write_codes_to(self, fileobj):
+        """Writes the map's tile codes, one byte per tile row by row, to a file opened in
+        binary mode, a band at a time
+        """
+        for top, band in self.iter_bands():
+            fileobj.write(band.read_rows(0, band.height))
+
+    def _place_mesas(self, band):
+        placed = _place_band_mesas(self.width, self.height, self.seed, band, self.mesa_max_radius, self.mesa_map_density)
+        return [Mesa(x, y, r) for x, y, r in placed]
+
+    def _plan_bridges(self, band, mesas, earlier_bridges):
+        """Returns (bridge, mesa, mesa2) for the bridges from the band's mesas to their nearest
+        neighbours east and south, shortest first, skipping any that would join mesas already
+        joined by bridges from this band or the one before
+        """
+        window = [mesa for near_band in range(band - 1, band + 2) for mesa in mesas.get(near_band, ())]
+        index = PatchIndex()
+        for mesa in window:
+            index.insert(mesa)
+        order = dict((id(mesa), position) for position, mesa in enumerate(window))
+
+        candidates = []
+        for mesa in mesas[band]:
+            for direction in ('E', 'S'):
+                other = index.nearest_colinear(mesa, direction)
+                if other is None:
+                    continue
+                if direction == 'E':
+                    gap = other.x - (mesa.x + mesa.width)
+                else:
+                    gap = other.y - (mesa.y + mesa.height)
+                #See Gamemap.connect_mesas
+                if gap > 0:
+                    candidates.append((gap, order[id(mesa)], direction, order[id(other)]))
+
+        #Kruskal's algorithm over the window's mesas, by id
+        parents = {}
+        def find(key):
+            root = key
+            while parents.get(root, root) != root:
+                root = parents[root]
+            parents[key] = root
+            return root
+        for bridge, mesa, mesa2 in earlier_bridges:
+            parents[find(id(mesa))] = find(id(mesa2))
+
+        rng = random.Random("{0}/bridges/{1}".format(self.seed, band))
+        planned = []
+        for gap, position, direction, other_position in sorted(candidates):
+            mesa, other = window[position], window[other_position]
+            root, other_root = find(id(mesa)), find(id(other))
+            if root == other_root:
+                continue
+            parents[root] = other_root
+            planned.append((plan_bridge(rng, mesa, other, direction), mesa, other))
+        return planned
+
+    def _draw_band(self, band, mesas, bridges):
+        """Returns a TileGrid of the band's rows with every mesa and bridge reaching into it drawn in"""
+        top = band * GENERATION_BAND_HEIGHT
+        grid = TileGrid(self.width, min(GENERATION_BAND_HEIGHT, self.height - top), TileManager.impass)
+        #Mesas and bridges only ever reach down into the band after their own
+        for near_band in (band - 1, band):
+            for mesa in mesas.get(near_band, ()):
+                grid.blit_clipped(mesa.x, mesa.y - top, get_mesa_stencil(mesa.r), TileManager.floor)
+        for near_band in (band - 1, band):
+            for bridge, mesa, mesa2 in bridges.get(near_band, ()):
+                for tile, stencil in bridge.get_stencils():
+                    grid.blit_clipped(bridge.x, bridge.y - top, stencil, tile)
+        return grid
@@ -0,0 +1,211 @@
+"""Compact storage for grids of map tiles
+
+Rather than holding a Tile object reference per cell, a TileGrid stores one byte per cell.
+Each byte is a tile code that indexes into a palette of Tile objects. A 4096x4096 grid takes
+16MB this way instead of the hundreds of MB a list of lists of references would need.
+"""
+from tilemanager import TileManager
+
+#Cache of translate tables for row_mask, keyed by the set of tile codes they select
+_mask_tables = {}
+
+class TileGrid(object):
+    """A width by height grid of tiles, stored row-major as one byte per cell"""
+
+    def __init__(self, width, height, fill=None, palette=None, codes=None):
+        """codes, if given, is an existing buffer of width*height tile codes to use as storage
+        instead of allocating a new one. Anything that indexes and slices like a bytearray
+        works, including a writable mmap.
+        """
+        self.width = width
+        self.height = height
+        self.palette = TileManager.palette if palette is None else palette
+        if codes is None:
+            fill_code = 0 if fill is None else fill.code
+            codes = bytearray([fill_code]) * (width * height)
+        elif len(codes) != width * height:
+            raise ValueError("Expected {0} tile codes for a {1}x{2} grid, got {3}".format(width * height, width, height, len(codes)))
+        self._codes = codes
+
+    def get(self, x, y):
+        return self.palette[self._codes[self._index(x, y)]]
+
+    def set(self, x, y, tile):
+        self._codes[self._index(x, y)] = tile.code
+
+    def get_code(self, x, y):
+        return self._codes[self._index(x, y)]
+
+    def set_code(self, x, y, code):
+        self._codes[self._index(x, y)] = code
+
+    def row_codes(self, y):
+        """Returns a copy of the tile codes in row y"""
+        start = self._index(0, y)
+        return self._codes[start:start + self.width]
+
+    def raw_codes(self):
+        """Returns the grid's underlying buffer of tile codes, row by row, for code that needs
+        to scan it without a method call per cell. Writes to it change the grid.
+        """
+        return self._codes
+
+    def read_rows(self, y_start, y_end):
+        """Returns the tile codes of rows y_start up to but not including y_end, as bytes"""
+        return bytes(self._codes[y_start * self.width:y_end * self.width])
+
+    def write_rows(self, y_start, data):
+        """Overwrites whole rows, starting at row y_start, with tile codes from data"""
+        if len(data) % self.width != 0 or y_start * self.width + len(data) > len(self._codes):
+            raise IndexError("{0} bytes of rows don't fit at row {1} of a {2}x{3} grid".format(len(data), y_start, self.width, self.height))
+        self._codes[y_start * self.width:y_start * self.width + len(data)] = data
+
+    def crop(self, x, y, width, height):
+        """Returns a new TileGrid holding a copy of the width x height box with its top-left corner at x,y"""
+        cropped = TileGrid(width, height, palette=self.palette)
+        for i_y in range(height):
+            start = self._index(x, y + i_y)
+            cropped._codes[i_y * width:(i_y + 1) * width] = self._codes[start:start + width]
+        return cropped
+
+    def row_mask(self, y, tiles):
+        """Returns row y as a byte mask: an int with one byte per cell, most significant
+        byte first, that is 0x01 where the cell holds one of the given tiles and 0x00 elsewhere.
+
+        Shifting a mask by 8 bits moves it by one cell, so whole-row neighbor tests
+        become a few big-int operations instead of a Python loop.
+        """
+        return int.from_bytes(self.row_codes(y).translate(self._mask_table(tiles)), 'big')
+
+    def set_row_mask(self, y, mask, tile):
+        """Sets every cell in row y whose byte in mask is 0x01 to tile"""
+        self._write_mask(self._index(0, y), self.width, mask, tile.code)
+
+    def blit(self, x, y, stencil, tile):
+        """Sets every cell covered by stencil to tile, with the stencil's top-left corner at x,y.
+
+        Stencils are anything with a width and a list of row_masks in the row_mask format.
+        Unlike single cells, stencils don't wrap around, so one that doesn't fit entirely inside
+        the grid raises IndexError (see blit_clipped).
+        """
+        if x < 0 or y < 0 or x + stencil.width > self.width or y + len(stencil.row_masks) > self.height:
+            raise IndexError("A {0}x{1} stencil at {2},{3} doesn't fit in a {4}x{5} grid".format(
+                stencil.width, len(stencil.row_masks), x, y, self.width, self.height))
+        for i_y, mask in enumerate(stencil.row_masks):
+            if mask:
+                self._write_mask((y + i_y) * self.width + x, stencil.width, mask, tile.code)
+
+    def blit_clipped(self, x, y, stencil, tile):
+        """Like blit, but silently drops the parts of the stencil that fall outside the grid.
+        x and y may be negative.
+        """
+        left_cut = max(0, -x)
+        right_cut = max(0, x + stencil.width - self.width)
+        length = stencil.width - left_cut - right_cut
+        if length <= 0:
+            return
+        keep = (1 << (8 * length)) - 1
+        for i_y, mask in enumerate(stencil.row_masks):
+            if 0 <= y + i_y < self.height:
+                mask = (mask >> (8 * right_cut)) & keep
+                if mask:
+                    self._write_mask((y + i_y) * self.width + x + left_cut, length, mask, tile.code)
+
+    def _write_mask(self, start, length, mask, code):
+        """Writes code into the cells of the length-byte span at start that are set in mask"""
+        span = int.from_bytes(self._codes[start:start + length], 'big')
+        span = (span & ~(mask * 0xFF)) | (mask * code)
+        self._codes[start:start + length] = span.to_bytes(length, 'big')
+
+    def _mask_table(self, tiles):
+        """Returns a bytes.translate table mapping the codes of tiles to 1 and all others to 0"""
+        codes = frozenset(tile.code for tile in tiles)
+        if codes not in _mask_tables:
+            _mask_tables[codes] = bytes(1 if code in codes else 0 for code in range(256))
+        return _mask_tables[codes]
+
+    def _index(self, x, y):
+        """Turns x,y coordinates into an offset into the code array.
+
+        Negative coordinates count back from the far edge along their own axis,
+        the same way indexing into a list of lists would.
+        """
+        if x < 0:
+            x += self.width
+        if y < 0:
+            y += self.height
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError("list index out of range")
+        return y * self.width + x
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, y):
+        """grid[y] is a view of row y, so grid[y][x] behaves like the old list of lists"""
+        if isinstance(y, slice):
+            return [TileRow(self, i_y) for i_y in range(*y.indices(self.height))]
+        if y < 0:
+            y += self.height
+        if not 0 <= y < self.height:
+            raise IndexError("list index out of range")
+        return TileRow(self, y)
+
+    def __iter__(self):
+        for y in range(self.height):
+            yield TileRow(self, y)
+
+    def iter_lines(self):
+        """Yields the grid as text, one row at a time, each line ending in a newline.
+        Only one row is held in memory at once.
+        """
+        table = get_char_table(self.palette)
+        if table is None:
+            palette = self.palette
+            for y in range(self.height):
+                yield "".join([palette[code].char for code in self.row_codes(y)]) + '\n'
+        else:
+            for y in range(self.height):
+                yield self.row_codes(y).translate(table).decode('latin-1') + '\n'
+
+    def write_to(self, fileobj):
+        """Writes the grid as text to a file opened in text mode, a row at a time"""
+        for line in self.iter_lines():
+            fileobj.write(line)
+
+
+def get_char_table(palette):
+    """Returns a bytes.translate table from tile codes to their tiles' characters, encoded
+    as latin-1, or None if some character doesn't fit in one latin-1 byte.
+    """
+    table = bytearray(b'?' * 256)
+    for code, tile in enumerate(palette):
+        if len(tile.char) != 1 or ord(tile.char) > 0xFF:
+            return None
+        table[code] = ord(tile.char)
+    return bytes(table)
+
+
+class TileRow(object):
+    """A read-only view of a single row of a TileGrid"""
+
+    def __init__(self, grid, y):
+        self.grid = grid
+        self.y = y
+
+    def codes(self):
+        return self.grid.row_codes(self.y)
+
+    def __len__(self):
+        return self.grid.width
+
+    def __getitem__(self, x):
+        if isinstance(x, slice):
+            palette = self.grid.palette
+            return [palette[code] for code in self.codes()[x]]
+        return self.grid.get(x, self.y)
+
+    def __iter__(self):
+        palette = self.grid.palette
+        for code in self.codes():
+            yield palette[code]
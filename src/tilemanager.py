@@ -1,12 +1,18 @@
 from __future__ import division
 
-import curses
-
 class Tile(object):
     """Represents a tile on the map."""
-    def __init__(self, char, color=None):
+    __slots__ = ('char', 'color', 'code', 'foreground', 'background', 'bold')
+
+    def __init__(self, char, color=None, foreground=None, background=None, bold=False):
         self.char = char
         self.color = color
+        #Index into TileManager.palette, used by compact map storage
+        self.code = None
+        #Color names, for tiles that aren't in the palette, such as those of entities
+        self.foreground = foreground
+        self.background = background
+        self.bold = bold
 
     def __str__(self):
         return self.char
@@ -20,11 +26,17 @@ class TileManager(object):
     test_1 = Tile('1')
     test_2 = Tile('2')
 
+    #Maps store one-byte tile codes, which index into this list.
+    #Only append to it - reordering would change the meaning of existing codes.
+    palette = [impass, floor, wall, bridge, test_tile, test_1, test_2]
+
     def __init__(self):
         self.init_colors()
 
     def init_colors(self):
         """Initializes curses colors and applies them to tiles"""
+        #Imported here so that maps can be generated headless, without curses
+        import curses
         #1 is currently reserved for error messages
         curses.init_pair(2, curses.COLOR_BLUE, curses.COLOR_BLACK)
         curses.init_pair(3, curses.COLOR_WHITE, curses.COLOR_BLACK)
@@ -37,3 +49,6 @@ class TileManager(object):
         TileManager.wall.color = curses.color_pair(3)
         TileManager.floor.color = curses.color_pair(4)
         TileManager.bridge.color = curses.color_pair(5)
+
+for code, tile in enumerate(TileManager.palette):
+    tile.code = code
@@ -0,0 +1,150 @@
+"""The game world: the map, plus the entities on it and whatever else occupies its cells
+
+Entities are indexed by the cell they're in, so finding what's in a cell doesn't mean looking
+at every entity. Entities that want to know when the player is about to step near them register
+with a radius, and only hear about cells within it.
+"""
+import collections
+
+import events
+
+#Side length of the buckets nearby-listeners are filed in
+LISTENER_BUCKET_SIZE = 16
+
+class CellFeature(object):
+    """Something fixed in a map cell, such as a portal. Cells with nothing special in them
+    have an instance of this base class, which lets the player through.
+    """
+
+    def player_collision(self, player):
+        """Called when the player attempts to enter this cell
+
+        Return whether the player should complete the move or not.
+        """
+        return True
+
+
+class GameWorld(object):
+    """A Gamemap plus the entities and features in its cells"""
+
+    def __init__(self, gamemap):
+        self.gamemap = gamemap
+        #(x, y) -> list of entities in that cell. Cells with no entities have no entry.
+        self._cells = {}
+        #(x, y) -> CellFeature, for cells with something other than the default
+        self._features = {}
+        self.default_feature = CellFeature()
+        #entity -> radius, for entities listening for the player entering nearby cells
+        self._nearby_listeners = {}
+        #(bucket_x, bucket_y) -> listening entities whose radius reaches into the bucket, as the
+        #keys of a dict so they're told in the order they started listening
+        self._listener_buckets = collections.defaultdict(dict)
+        self._entity_count = 0
+
+        self.subscriptions = [
+            events.listen_to_event("world_add_entity", self.add_entity),
+            events.listen_to_event("on_entity_death", self.remove_entity),
+        ]
+
+    def __len__(self):
+        return self._entity_count
+
+    def update_world(self, tick):
+        """Called by the game loop once per world tick. Fires "world_tick" with the world and
+        the tick number, for anything that acts over time.
+        """
+        events.trigger_event("world_tick", self, tick)
+
+    def get_cell(self, x, y):
+        """Returns (feature, entities) for the cell at x, y, where entities is a new list.
+        Suitable as an Entity's get_gameworld_cell.
+        """
+        return self._features.get((x, y), self.default_feature), list(self._cells.get((x, y), ()))
+
+    def entities_at(self, x, y):
+        return list(self._cells.get((x, y), ()))
+
+    def set_feature(self, x, y, feature):
+        """Put a CellFeature in a cell, or None to put the default back"""
+        if feature is None:
+            self._features.pop((x, y), None)
+        else:
+            self._features[(x, y)] = feature
+
+    def add_entity(self, entity):
+        """Put an entity in the world at its current x, y"""
+        entity.world = self
+        self._cells.setdefault((entity.x, entity.y), []).append(entity)
+        self._entity_count += 1
+        self.gamemap.dirty_regions.mark(entity.x, entity.y)
+
+    def remove_entity(self, entity):
+        """Take an entity out of the world. Does nothing if it isn't in this one."""
+        if getattr(entity, "world", None) is not self:
+            return
+        self._unindex(entity, entity.x, entity.y)
+        self.stop_listening_nearby(entity)
+        entity.world = None
+        self._entity_count -= 1
+        self.gamemap.dirty_regions.mark(entity.x, entity.y)
+
+    def move_entity(self, entity, x, y):
+        """Move an entity in the world to x, y"""
+        old_x, old_y = entity.x, entity.y
+        self._unindex(entity, old_x, old_y)
+        entity.x, entity.y = x, y
+        self._cells.setdefault((x, y), []).append(entity)
+        radius = self._nearby_listeners.get(entity)
+        if radius is not None:
+            self._file_listener(entity, old_x, old_y, radius, add=False)
+            self._file_listener(entity, x, y, radius, add=True)
+
+    def listen_nearby(self, entity, radius):
+        """Have entity.on_player_enter_space(player, x, y) called whenever the player is about to
+        enter a cell within radius cells of the entity, counting diagonal steps as one.
+        Calling it again changes the radius.
+        """
+        self.stop_listening_nearby(entity)
+        self._nearby_listeners[entity] = radius
+        self._file_listener(entity, entity.x, entity.y, radius, add=True)
+
+    def stop_listening_nearby(self, entity):
+        radius = self._nearby_listeners.pop(entity, None)
+        if radius is not None:
+            self._file_listener(entity, entity.x, entity.y, radius, add=False)
+
+    def trigger_enter_space(self, player, x, y):
+        """Tell the entities listening near x, y that the player is about to enter it"""
+        bucket_key = (x // LISTENER_BUCKET_SIZE, y // LISTENER_BUCKET_SIZE)
+        bucket = self._listener_buckets.get(bucket_key)
+        if not bucket:
+            return
+        radius_of = self._nearby_listeners
+        #Copied, since a listener might leave the world or move in response
+        for entity in list(bucket):
+            if entity is not player and max(abs(entity.x - x), abs(entity.y - y)) <= radius_of.get(entity, -1):
+                entity.on_player_enter_space(player, x, y)
+
+    def _unindex(self, entity, x, y):
+        cell = self._cells.get((x, y))
+        if cell is None or entity not in cell:
+            raise ValueError("Entity is not at {0}, {1}".format(x, y))
+        cell.remove(entity)
+        if not cell:
+            del self._cells[(x, y)]
+
+    def _file_listener(self, entity, x, y, radius, add):
+        """Adds entity to, or removes it from, every bucket within radius of x, y"""
+        size = LISTENER_BUCKET_SIZE
+        buckets = self._listener_buckets
+        for bucket_y in range((y - radius) // size, (y + radius) // size + 1):
+            for bucket_x in range((x - radius) // size, (x + radius) // size + 1):
+                key = (bucket_x, bucket_y)
+                if add:
+                    buckets[key][entity] = None
+                else:
+                    bucket = buckets.get(key)
+                    if bucket is not None:
+                        bucket.pop(entity, None)
+                        if not bucket:
+                            del buckets[key]
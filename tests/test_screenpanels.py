@@ -0,0 +1,41 @@
+"""Tests for message wrapping in screenpanels
+
+Run from the repository root with: python3 -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from screenpanels import wrap_message
+
+class WrapMessageTest(unittest.TestCase):
+
+    def test_words_fill_rows(self):
+        self.assertEqual(wrap_message("one two three", 10, 5), ((" one two", " three"), None))
+
+    def test_trailing_newline_leaves_a_blank_row(self):
+        #Headers like "Carrying:\n" rely on this to separate themselves from the list below
+        self.assertEqual(wrap_message("Carrying:\n", 30, 5), ((" Carrying:", " "), None))
+        self.assertEqual(wrap_message("Choose item to drop:\n", 30, 5), ((" Choose item to drop:", " "), None))
+
+    def test_repeated_newlines_leave_a_blank_row_each(self):
+        self.assertEqual(wrap_message("a\n\nb", 30, 5), ((" a", " ", " b"), None))
+        self.assertEqual(wrap_message("a\n\n\n", 30, 5), ((" a", " ", " ", " "), None))
+
+    def test_empty_message_is_one_blank_row(self):
+        self.assertEqual(wrap_message("", 30, 5), ((" ",), None))
+
+    def test_blank_row_that_doesnt_fit_is_left_over(self):
+        rows, remaining = wrap_message("a\nb\n", 30, 2)
+        self.assertEqual(rows, (" a", " b"))
+        self.assertEqual(remaining, "")
+
+    def test_long_word_is_broken(self):
+        rows, remaining = wrap_message("abcdefghij", 6, 5)
+        self.assertEqual(rows, (" abc-", " def-", " ghij"))
+        self.assertIsNone(remaining)
+
+if __name__ == "__main__":
+    unittest.main()